@@ -0,0 +1,189 @@
+# admission.py
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+
+# 优先级 (数值越小越优先)
+PRIORITY_SCHEDULED = 0    # 调度器任务、自动化规则
+PRIORITY_INTERACTIVE = 1  # CLI / 网络客户端的单设备操作 (open/close/set/get)
+PRIORITY_BULK = 2         # 批量读取 (status_all)、后台轮询
+PRIORITY_NAMES = {
+    PRIORITY_SCHEDULED: "scheduled",
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BULK: "bulk",
+}
+
+class DeviceBusyError(Exception):
+    """控制器繁忙 (队列已满或客户端超出速率限制)，请求被立即拒绝，客户端应稍后重试"""
+    pass
+
+class TokenBucket:
+    """令牌桶：以 rate 个/秒 的速度补充令牌，最多积累 burst 个"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def try_consume(self, amount=1.0):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+class PriorityGate:
+    """
+    带优先级通道的准入控制器，替代 DeviceManager 原来的 Semaphore(1)。
+    - acquire(priority): 同时最多 capacity 个操作访问 HAL；等待者按 (优先级, 到达顺序) 出队，
+      调度任务和交互式写操作排在批量读取之前
+    - 每个优先级通道的排队数超过 max_queue 时立即抛出 DeviceBusyError，而不是无限排队
+    - admit(client_id): 按客户端的令牌桶限速，超出速率立即抛出 DeviceBusyError
+    """
+    DEFAULT_MAX_QUEUE = {PRIORITY_SCHEDULED: 100, PRIORITY_INTERACTIVE: 50, PRIORITY_BULK: 20}
+    MAX_BUCKETS = 1024
+
+    def __init__(self, capacity=1, max_queue=None, client_rate=20.0, client_burst=40.0):
+        """
+        :param capacity: 同时访问 HAL 的最大操作数
+        :param max_queue: {优先级: 最大排队数}
+        :param client_rate: 每个客户端每秒允许的请求数 (<= 0 表示不限速)
+        :param client_burst: 每个客户端允许的突发请求数
+        """
+        self.capacity = capacity
+        self.max_queue = dict(self.DEFAULT_MAX_QUEUE)
+        if max_queue:
+            self.max_queue.update(max_queue)
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+
+        self._cond = threading.Condition()
+        self._in_use = 0
+        self._waiters = []   # 堆 [(priority, seq)]
+        self._seq = 0
+        self._queue_depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self._admitted = {priority: 0 for priority in PRIORITY_NAMES}
+        self._rejected = {priority: 0 for priority in PRIORITY_NAMES}
+        self._max_wait = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self._rate_limited = 0
+        self._buckets = {}   # client_id -> TokenBucket
+        self._buckets_lock = threading.Lock()
+
+    def admit(self, client_id, cost=1.0):
+        """按客户端限速。client_id 为 None 表示内部调用 (调度器、CLI、规则)，不限速。"""
+        if client_id is None or self.client_rate <= 0:
+            return
+        with self._buckets_lock:
+            bucket = self._buckets.get(client_id)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_BUCKETS:
+                    self._prune_buckets()
+                bucket = self._buckets[client_id] = TokenBucket(self.client_rate, self.client_burst)
+            allowed = bucket.try_consume(cost)
+            if not allowed:
+                self._rate_limited += 1
+        if not allowed:
+            raise DeviceBusyError(f"客户端 {client_id} 请求过于频繁 (限制 {self.client_rate:g} 次/秒)，请稍后重试")
+
+    def _prune_buckets(self):
+        """丢弃已经补满的令牌桶 (即最近空闲的客户端)，限制内存占用 (调用者持有 _buckets_lock)"""
+        now = time.monotonic()
+        idle = [client_id for client_id, bucket in self._buckets.items()
+                if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst]
+        for client_id in idle:
+            del self._buckets[client_id]
+
+    @contextmanager
+    def acquire(self, priority=PRIORITY_INTERACTIVE):
+        """获取 HAL 访问权 (上下文管理器)。排队已满时抛出 DeviceBusyError。"""
+        start_time = time.monotonic()
+        with self._cond:
+            if self._in_use >= self.capacity or self._waiters:
+                if self._queue_depth[priority] >= self.max_queue[priority]:
+                    self._rejected[priority] += 1
+                    raise DeviceBusyError(f"控制器繁忙: {PRIORITY_NAMES[priority]} 队列已满 "
+                                          f"({self.max_queue[priority]})，请稍后重试")
+                self._seq += 1
+                entry = (priority, self._seq)
+                heapq.heappush(self._waiters, entry)
+                self._queue_depth[priority] += 1
+                try:
+                    self._cond.wait_for(lambda: self._in_use < self.capacity and self._waiters[0] == entry)
+                except BaseException:
+                    # 等待被中断 (例如 KeyboardInterrupt)：把自己移出队列，否则后面的等待者永远排不到队首
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                    raise
+                finally:
+                    self._queue_depth[priority] -= 1
+                heapq.heappop(self._waiters) # 队首就是自己
+                if self._waiters and self._in_use + 1 < self.capacity:
+                    # 还有空闲槽位: 唤醒新的队首 (它之前被唤醒时不在队首，已经回去等待了)
+                    self._cond.notify_all()
+            self._in_use += 1
+            self._admitted[priority] += 1
+            waited = time.monotonic() - start_time
+            if waited > self._max_wait[priority]:
+                self._max_wait[priority] = waited
+        try:
+            yield waited
+        finally:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify_all()
+
+    def get_stats(self):
+        """返回各优先级通道的排队深度、通过数、拒绝数，以及限速拒绝数"""
+        with self._cond:
+            lanes = {name: {"queue_depth": self._queue_depth[priority],
+                            "max_queue": self.max_queue[priority],
+                            "admitted": self._admitted[priority],
+                            "rejected": self._rejected[priority],
+                            "max_wait_ms": round(self._max_wait[priority] * 1000, 1)}
+                     for priority, name in PRIORITY_NAMES.items()}
+            in_use = self._in_use
+        with self._buckets_lock:
+            return {"in_use": in_use, "capacity": self.capacity, "lanes": lanes,
+                    "rate_limited": self._rate_limited, "tracked_clients": len(self._buckets)}
+
+
+# --- 测试代码: 大量批量读取期间，调度/交互操作仍然优先通过 ---
+if __name__ == "__main__":
+    gate = PriorityGate(capacity=1, max_queue={PRIORITY_BULK: 10})
+    order = []
+    busy = []
+
+    def operation(priority, name, hold=0.01):
+        try:
+            with gate.acquire(priority):
+                order.append(name)
+                time.sleep(hold)
+        except DeviceBusyError:
+            busy.append(name)
+
+    threads = [threading.Thread(target=operation, args=(PRIORITY_BULK, f"bulk_{i}")) for i in range(30)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    late = [threading.Thread(target=operation, args=(PRIORITY_SCHEDULED, "scheduled_0700")),
+            threading.Thread(target=operation, args=(PRIORITY_INTERACTIVE, "cli_open"))]
+    for thread in late:
+        thread.start()
+    for thread in threads + late:
+        thread.join()
+    print(f"执行顺序 (前 8 个): {order[:8]}")
+    print(f"scheduled_0700 位置: {order.index('scheduled_0700')}，cli_open 位置: {order.index('cli_open')}")
+    print(f"被拒绝的批量请求: {len(busy)}")
+
+    limited = 0
+    for _ in range(100):
+        try:
+            gate.admit("tcp:10.0.0.5")
+        except DeviceBusyError:
+            limited += 1
+    print(f"同一客户端连续 100 次请求中被限速: {limited} 次")
+    print(gate.get_stats())
@@ -1,6 +1,10 @@
 # device_manager.py
 # from hal_mock import MockHAL, DeviceNotFoundError # 注释掉旧的
 from hal_actual import ActualHAL, DeviceConfigurationError # 导入新的 HAL 和异常
+from admission import PriorityGate, PRIORITY_INTERACTIVE, PRIORITY_BULK, PRIORITY_NAMES
+from sensor_poller import AdaptiveSensorPoller
+from profiler import profiler
+import os
 import threading
 import time
 
@@ -13,10 +17,21 @@ class DeviceManager:
     设备管理器。
     负责通过 ActualHAL 与设备驱动进行交互，并管理设备信息。
     """
-    def __init__(self, hal: ActualHAL): # 类型提示改为 ActualHAL
+    DEVICE_LIST_REFRESH = 30.0 # list_all_devices 重新向 HAL 获取设备列表的最短间隔 (秒)
+    DEVICE_MISS_REFRESH = 1.0  # 请求未知设备 ID 时重新获取设备列表的最短间隔 (秒)
+
+    def __init__(self, hal: ActualHAL, journal=None, state_table=None, access_gate=None, rollups=None,
+                 backend_gates=None): # 类型提示改为 ActualHAL
         """
         初始化设备管理器。
         :param hal: 一个 ActualHAL 的实例
+        :param journal: 可选的 StateJournal 实例，用于持久化状态变化并在重启后恢复
+        :param state_table: 可选的 SharedStateTable 实例，把设备状态发布到共享内存供本机进程读取
+        :param access_gate: 可选的 PriorityGate 实例 (准入控制配置)，默认同时只允许一个操作访问 HAL
+        :param rollups: 可选的 SensorRollupStore 实例，把传感器读数汇总为分钟/小时粒度的长期数据
+        :param backend_gates: 可选的 {HAL 前缀: PriorityGate}，hal 为 CompositeHAL 时这些后端的设备使用各自的
+                              准入控制 (例如允许多个请求同时转发给远程控制器)，其余设备仍使用 access_gate。
+                              客户端限速 (admit) 始终由 access_gate 负责
         """
         if hal is None:
             raise ValueError("HAL instance cannot be None")
@@ -30,30 +45,118 @@ class DeviceManager:
         except Exception as e:
              print(f"DeviceManager Error: 初始化时无法从 HAL 获取设备列表: {e}")
              self._known_devices = {} # 初始化为空字典
+        # 设备列表会被刷新 (例如启动时不可达的远程楼层恢复后)：刷新时整体替换字典，读者无需加锁
+        self._refresh_lock = threading.Lock()
+        self._devices_refreshed_at = time.monotonic()
+
+        # 使用带优先级通道的准入控制替代之前的 Semaphore(1)：
+        # 同样限制同时调用 HAL 的操作数量，但等待者按优先级出队 (调度/交互写操作优先于批量读取)，
+        # 并对网络客户端限速，队列过长时立即以 DeviceBusyError 拒绝
+        self._access_gate = access_gate or PriorityGate(capacity=1)
+        print(f"DeviceManager: 使用优先级准入控制限制对 HAL 的并发访问 (capacity={self._access_gate.capacity})。")
+        self._backend_gates = dict(backend_gates or {})
+        for prefix, gate in self._backend_gates.items():
+            print(f"DeviceManager: 后端 '{prefix}' 使用独立的准入控制 (capacity={gate.capacity})。")
+
+        # 状态缓存: 记录每个设备最近一次观测到的状态 {'state': ..., 'last_updated': ...}
+        self._state_cache = {}
+        self._cache_lock = threading.Lock()
+        # 状态版本: 设备状态每变化一次加 1 (由 _cache_lock 保护)
+        self._versions = {}
+        self._house_version = 0 # 任一设备状态变化都会加 1
+        # 本次启动的随机实例标识: 版本号在重启后从头计数，HTTP ETag 带上它才不会与上次运行发出的 ETag 重复
+        self.instance_id = os.urandom(4).hex()
+        self._change_cond = threading.Condition(self._cache_lock) # 状态变化时通知等待者 (长轮询)
+        self._record_lock = threading.Lock() # 串行化 _record_state，日志的写入顺序与缓存的更新顺序一致
+
+        # 状态监听器: 每次观测到设备状态时回调 callback(device_id, state_info, previous)
+        self._state_listeners = []
+
+        # 后台传感器轮询 (见 start_sensor_poller)，启用后传感器的 get 优先返回缓存
+        self._poller = None
+        self._cache_hits = 0
+        self._hal_reads = 0
+
+        # 从状态日志恢复上次运行时的设备状态
+        self.journal = journal
+        if self.journal is not None:
+            recovered = self.journal.recover()
+            for device_id, state_info in recovered["devices"].items():
+                if device_id in self._known_devices:
+                    self._state_cache[device_id] = state_info
+                    # 恢复出的状态也是一次观测: 版本从 1 开始，条件请求在重启后即可命中
+                    self._versions[device_id] = 1
+                    self._house_version += 1
+            print(f"DeviceManager: 从状态日志恢复了 {len(self._state_cache)} 个设备的上次状态。")
+            self.journal.start()
+
+        # 共享内存状态表: 为每个设备分配槽位，并发布已知的 (恢复出的) 状态
+        self.state_table = state_table
+        if self.state_table is not None:
+            for device_id, device_type in self._known_devices.items():
+                try:
+                    self.state_table.register(device_id, device_type)
+                except Exception as e:
+                    print(f"DeviceManager Error: 无法在共享状态表中注册 {device_id}: {e}")
+            for device_id, state_info in self._state_cache.items():
+                self.state_table.update(device_id, state_info, self._versions[device_id])
 
-        # 使用信号量替代之前的 manager_lock，演示信号量用法
-        # 限制同时调用 HAL 的操作数量，例如只允许一个任务同时操作HAL
-        self._access_semaphore = threading.Semaphore(1) # 只允许一个线程同时访问 HAL
-        print("DeviceManager: 使用信号量限制对 HAL 的并发访问 (value=1)。")
+        # 传感器长期汇总: 作为状态监听器接收每次观测到的读数
+        self.rollups = rollups
+        if self.rollups is not None:
+            self.add_state_listener(self.rollups.on_state_change)
 
 
-    def get_device_state(self, device_id):
+    def get_device_state(self, device_id, priority=PRIORITY_INTERACTIVE, client_id=None, max_age=None):
         """
         获取指定设备的状态。
         :param device_id: 设备 ID
+        :param priority: 准入优先级 (admission.PRIORITY_*)
+        :param client_id: 发起请求的客户端标识，用于限速；None 表示内部调用，不限速
+        :param max_age: 可接受的缓存年龄 (秒)，缓存足够新时直接返回缓存，不访问 HAL；
+                        0 表示强制读取设备；None 表示由后台轮询决定 (被轮询的传感器使用其当前轮询间隔)
         :return: 包含状态信息的字典 {'state': ..., 'last_updated': ...}，如果设备不存在或出错则返回 None
+        :raises DeviceBusyError: 客户端超出速率限制或该优先级队列已满
         """
+        if device_id not in self._known_devices:
+            self._refresh_devices(self.DEVICE_MISS_REFRESH)
         if device_id not in self._known_devices:
              print(f"DeviceManager Warning: 设备 {device_id} 未在已知设备列表中。")
              return None
 
-        print(f"DeviceManager: 请求获取设备 {device_id} 状态，等待信号量...")
-        with self._access_semaphore: # 获取信号量
-            print(f"DeviceManager: 获得信号量，调用 HAL 获取 {device_id} 状态...")
+        if max_age is None and self._poller is not None:
+            max_age = self._poller.get_max_age(device_id)
+        if max_age:
+            cached = self.get_cached_state(device_id)
+            if cached and time.time() - cached["last_updated"] <= max_age:
+                self._cache_hits += 1
+                return cached
+
+        self._access_gate.admit(client_id)
+        return self._read_device_state(device_id, priority)
+
+    def _gate_for(self, device_id):
+        """设备所属后端的准入控制: backend_gates 中配置了该后端时用它，否则用全局的 access_gate"""
+        if self._backend_gates:
             try:
+                gate = self._backend_gates.get(self.hal.backend_of(device_id))
+            except DeviceNotFoundError:
+                gate = None
+            if gate is not None:
+                return gate
+        return self._access_gate
+
+    def _read_device_state(self, device_id, priority):
+        """在准入控制下通过 HAL 读取设备状态 (不做限速)"""
+        print(f"DeviceManager: 请求获取设备 {device_id} 状态，等待准入 ({PRIORITY_NAMES[priority]})...")
+        with self._gate_for(device_id).acquire(priority) as waited: # 获取 HAL 访问权
+            profiler.trace_stage("gate_wait", waited)
+            print(f"DeviceManager: 获得访问权，调用 HAL 获取 {device_id} 状态...")
+            io_start = time.perf_counter()
+            try:
+                self._hal_reads += 1
                 state_info = self.hal.read_device(device_id)
                 print(f"DeviceManager: HAL 返回 {device_id} 状态: {state_info}")
-                return state_info
             except DeviceNotFoundError as e: # 捕捉新的/别名的异常
                 print(f"DeviceManager Warning: 设备 {device_id} 未找到或配置错误: {e}")
                 return None
@@ -62,17 +165,26 @@ class DeviceManager:
                 print(f"DeviceManager Error: 获取设备 {device_id} 状态时 HAL 出错: {e}")
                 return None
             finally:
-                 print(f"DeviceManager: 释放 {device_id} 状态获取的信号量。")
+                 profiler.trace_stage("hal_io", time.perf_counter() - io_start)
+                 print(f"DeviceManager: 释放 {device_id} 状态获取的访问权。")
+        # 在准入控制之外更新缓存/日志，避免延长 HAL 的占用时间
+        self._record_state(device_id, state_info)
+        return state_info
 
 
-    def set_device_state(self, device_id, state):
+    def set_device_state(self, device_id, state, priority=PRIORITY_INTERACTIVE, client_id=None):
         """
         设置指定设备的状态。
         :param device_id: 设备 ID
         :param state: 要设置的目标状态 (例如 "on", "off")
+        :param priority: 准入优先级 (admission.PRIORITY_*)
+        :param client_id: 发起请求的客户端标识，用于限速；None 表示内部调用，不限速
         :return: True 如果设置成功，False 如果失败或设备不支持写入
+        :raises DeviceBusyError: 客户端超出速率限制或该优先级队列已满
         """
         device_type = self._known_devices.get(device_id)
+        if not device_type and self._refresh_devices(self.DEVICE_MISS_REFRESH):
+            device_type = self._known_devices.get(device_id)
         if not device_type:
              print(f"DeviceManager Warning: 设备 {device_id} 未在已知设备列表中。")
              return False
@@ -82,13 +194,16 @@ class DeviceManager:
              print(f"DeviceManager Info: 不能直接设置传感器 {device_id} 的状态。")
              return False
 
-        print(f"DeviceManager: 请求设置设备 {device_id} 状态为 '{state}'，等待信号量...")
-        with self._access_semaphore: # 获取信号量
-            print(f"DeviceManager: 获得信号量，调用 HAL 设置 {device_id} 状态...")
+        self._access_gate.admit(client_id)
+        print(f"DeviceManager: 请求设置设备 {device_id} 状态为 '{state}'，等待准入 ({PRIORITY_NAMES[priority]})...")
+        with self._gate_for(device_id).acquire(priority) as waited: # 获取 HAL 访问权
+            profiler.trace_stage("gate_wait", waited)
+            print(f"DeviceManager: 获得访问权，调用 HAL 设置 {device_id} 状态...")
+            io_start = time.perf_counter()
             try:
                 success = self.hal.write_device(device_id, state)
+                written_at = time.time() # 在持有访问权时取时间戳，_record_state 据此丢弃过期的记录
                 print(f"DeviceManager: HAL 返回设置 {device_id} 结果: {success}")
-                return success
             except DeviceNotFoundError as e: # 捕捉新的/别名的异常
                 print(f"DeviceManager Warning: 设备 {device_id} 未找到或配置错误: {e}")
                 return False
@@ -97,39 +212,251 @@ class DeviceManager:
                 print(f"DeviceManager Error: 设置设备 {device_id} 状态时 HAL 出错: {e}")
                 return False
             finally:
-                 print(f"DeviceManager: 释放 {device_id} 状态设置的信号量。")
+                 profiler.trace_stage("hal_io", time.perf_counter() - io_start)
+                 print(f"DeviceManager: 释放 {device_id} 状态设置的访问权。")
+        if success:
+            self._record_state(device_id, {"state": self._normalize_state(state), "last_updated": written_at})
+        return success
+
+    @staticmethod
+    def _normalize_state(state):
+        """把写入的状态规范化为驱动读回的形式 ("on"/"off")，与 ActualHAL.write_device 的转换一致"""
+        if isinstance(state, bool):
+            return "on" if state else "off"
+        if isinstance(state, str):
+            state = state.lower()
+            return {"1": "on", "0": "off"}.get(state, state)
+        return state
+
+    def _record_state(self, device_id, state_info):
+        """
+        记录一次观测到的设备状态：更新状态缓存，并写入状态日志。
+        传感器的每次新读数都会记录 (作为历史；last_updated 与缓存相同的是同一个读数，不重复记录)，其他设备只在状态变化时记录。
+        本方法在释放准入控制后调用，并发操作的记录顺序可能与它们访问 HAL 的顺序相反：last_updated (持有访问权时取得)
+        早于已缓存状态的观测已经过期，直接丢弃。缓存、共享表和日志在 _record_lock 内按相同顺序更新。
+        """
+        with self._record_lock:
+            with self._cache_lock:
+                previous = self._state_cache.get(device_id)
+                if previous is not None and state_info["last_updated"] < previous["last_updated"]:
+                    return
+                self._state_cache[device_id] = dict(state_info)
+                if previous is None or previous["state"] != state_info["state"]:
+                    self._versions[device_id] = self._versions.get(device_id, 0) + 1
+                    self._house_version += 1
+                    self._change_cond.notify_all()
+                version = self._versions.get(device_id, 0)
+                if self.state_table is not None:
+                    # 在缓存锁内发布，保证共享表中的版本顺序与缓存一致
+                    self.state_table.update(device_id, state_info, version)
+            if self.journal is not None:
+                is_sensor = self._known_devices.get(device_id) == "sensor_temp"
+                if previous is None or (previous["last_updated"] != state_info["last_updated"] if is_sensor
+                                        else previous["state"] != state_info["state"]):
+                    try:
+                        self.journal.append(device_id, state_info["state"], state_info["last_updated"],
+                                            kind="reading" if is_sensor else "state")
+                    except Exception as e:
+                        print(f"DeviceManager Error: 写入状态日志失败 ({device_id}): {e}")
+        for callback in list(self._state_listeners):
+            try:
+                callback(device_id, dict(state_info), previous)
+            except Exception as e:
+                print(f"DeviceManager Error: 状态监听器处理 {device_id} 时出错: {e}")
+
+    def add_state_listener(self, callback):
+        """
+        注册状态监听器。每次观测到设备状态 (HAL 读取或成功写入) 后调用
+        callback(device_id, state_info, previous)，previous 为之前缓存的状态或 None。
+        回调在调用者线程中执行且不持有任何锁，应尽快返回。
+        """
+        self._state_listeners.append(callback)
+
+    def remove_state_listener(self, callback):
+        """注销状态监听器"""
+        if callback in self._state_listeners:
+            self._state_listeners.remove(callback)
+
+    def get_cached_state(self, device_id):
+        """
+        获取设备最近一次观测到的状态 (不访问 HAL)。
+        重启后，在第一次读取设备之前返回的是从状态日志恢复的状态。
+        :return: 状态字典的副本，没有记录则返回 None
+        """
+        with self._cache_lock:
+            state_info = self._state_cache.get(device_id)
+            return dict(state_info) if state_info else None
+
+    def get_device_version(self, device_id):
+        """
+        获取设备状态版本号 (状态每变化一次加 1，未观测过的设备为 0)。不访问 HAL。
+        """
+        with self._cache_lock:
+            return self._versions.get(device_id, 0)
+
+    def get_house_version(self):
+        """获取全屋状态版本号 (任一设备状态变化都会加 1)。不访问 HAL。"""
+        with self._cache_lock:
+            return self._house_version
+
+    def wait_for_change(self, device_id=None, since_version=0, timeout=30.0):
+        """
+        阻塞等待状态版本超过 since_version (用于长轮询)。不访问 HAL。
+        :param device_id: 等待指定设备的版本；为 None 时等待全屋版本
+        :return: 返回时的版本号 (超时则可能仍等于 since_version)
+        """
+        def current_version():
+            if device_id is None:
+                return self._house_version
+            return self._versions.get(device_id, 0)
+
+        with self._change_cond:
+            self._change_cond.wait_for(lambda: current_version() != since_version, timeout=timeout)
+            return current_version()
+
+    def get_sensor_history(self, device_id, since=None):
+        """
+        获取传感器的历史读数 (需要启用状态日志)。
+        :param since: 可选的起始时间戳
+        :return: [(timestamp, value), ...]
+        """
+        if self.journal is None:
+            return []
+        return self.journal.get_history(device_id, since)
 
+    def get_sensor_rollup(self, device_id, start=None, end=None, resolution=3600):
+        """
+        查询传感器的长期汇总 (需要启用 rollups)。
+        :param resolution: 汇总粒度 (秒)，60 或 3600
+        :return: 见 SensorRollupStore.query；未启用时返回 None
+        :raises ValueError: 不支持的汇总粒度
+        """
+        if self.rollups is None:
+            return None
+        return self.rollups.query(device_id, start, end, resolution)
 
-    def get_all_devices_status(self):
+    def start_sensor_poller(self, min_interval=5.0, max_interval=120.0, change_threshold=0.3):
+        """
+        启动后台自适应传感器轮询：温度变化时以 min_interval 附近的间隔读取，稳定时逐步退避到 max_interval。
+        读数进入状态缓存，之后对这些传感器的 get 在缓存不超过当前轮询间隔时直接返回缓存。
+        """
+        if self._poller is not None:
+            return
+        sensors = [device_id for device_id, device_type in self._known_devices.items() if device_type == "sensor_temp"]
+        if not sensors:
+            print("DeviceManager Info: 没有传感器，不启动后台轮询。")
+            return
+        self._poller = AdaptiveSensorPoller(self, sensors, min_interval=min_interval,
+                                            max_interval=max_interval, change_threshold=change_threshold)
+        self._poller.start()
+
+    def stop_sensor_poller(self):
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+
+    def get_stats(self):
+        """返回准入控制统计 (各优先级队列深度、通过数、拒绝数、限速次数，以及各后端的准入控制)、缓存命中、传感器轮询和 HAL 统计"""
+        stats = {"admission": self._access_gate.get_stats(),
+                 "cache": {"hits": self._cache_hits, "hal_reads": self._hal_reads}}
+        if self._backend_gates:
+            stats["backend_admission"] = {prefix: gate.get_stats() for prefix, gate in self._backend_gates.items()}
+        if self._poller is not None:
+            stats["poller"] = self._poller.get_stats()
+        if self.rollups is not None:
+            stats["rollups"] = self.rollups.get_stats()
+        if hasattr(self.hal, "get_stats"): # 例如 RemoteHAL/CompositeHAL 的连接池统计
+            stats["hal"] = self.hal.get_stats()
+        return stats
+
+    def close(self):
+        """关闭设备管理器持有的资源 (后台轮询、状态日志等)"""
+        self.stop_sensor_poller()
+        if self.journal is not None:
+            self.journal.close()
+        if self.rollups is not None:
+            self.rollups.close()
+        if self.state_table is not None:
+            self.state_table.close()
+
+
+    def get_all_devices_status(self, priority=PRIORITY_BULK, client_id=None):
         """
         获取所有已知设备的状态。
+        :param priority: 准入优先级，默认为批量读取通道
+        :param client_id: 发起请求的客户端标识，用于限速 (整个请求只计一次)
         :return: 一个字典，键是 device_id，值是包含状态的字典或 None
+        :raises DeviceBusyError: 客户端超出速率限制或该优先级队列已满
         """
         all_status = {}
         # 获取已知设备列表的副本
         known_devices_copy = list(self._known_devices.keys())
 
+        self._access_gate.admit(client_id)
         print("DeviceManager: 正在获取所有设备状态...")
-        # 注意：这里每次获取状态都会单独请求信号量
-        # 如果需要原子性地获取所有状态，信号量逻辑需要调整
+        # 注意：这里每次获取状态都会单独排队获取访问权，
+        # 因此更高优先级的操作可以插在两次读取之间，不会被整个批量读取阻塞
         for device_id in known_devices_copy:
-            # 调用自身的 get_device_state，它包含了信号量和错误处理
-            status = self.get_device_state(device_id)
+            # 调用 _read_device_state，它包含了准入控制和错误处理
+            status = self._read_device_state(device_id, priority)
             all_status[device_id] = status
             # 短暂休眠，避免过于频繁地访问设备文件（可选）
             time.sleep(0.05)
         print("DeviceManager: 获取所有设备状态完成。")
         return all_status
 
-    def list_all_devices(self):
+    def list_all_devices(self, refresh=True):
         """
         列出所有已知的设备及其类型。
+        :param refresh: 是否按 DEVICE_LIST_REFRESH 间隔向 HAL 重新获取设备列表 (可能是网络调用)；
+                        不应访问 HAL 的路径 (例如 HTTP 304/长轮询) 传 False
         :return: 一个字典，键是 device_id，值是设备类型
         """
-        # 返回已知设备列表的副本
-        # 如果 HAL 支持动态发现，这里可能需要重新调用 HAL
+        # 返回已知设备列表的副本，定期向 HAL 重新获取以发现新上线的设备
+        if refresh:
+            self._refresh_devices(self.DEVICE_LIST_REFRESH)
         return self._known_devices.copy()
 
+    def has_device(self, device_id):
+        """设备是否已知；未知时按 DEVICE_MISS_REFRESH 间隔刷新一次设备列表再判断"""
+        if device_id in self._known_devices:
+            return True
+        return self._refresh_devices(self.DEVICE_MISS_REFRESH) and device_id in self._known_devices
+
+    def _refresh_devices(self, min_interval):
+        """
+        重新向 HAL 获取设备列表，把新设备合并进已知设备 (注册共享内存槽位，新传感器加入后台轮询)。
+        只增不减: 暂时不可达的后端不会让它的设备消失。距上次刷新不足 min_interval 秒时不访问 HAL。
+        :return: 是否发现了新设备
+        """
+        with self._refresh_lock:
+            now = time.monotonic()
+            if now - self._devices_refreshed_at < min_interval:
+                return False
+            self._devices_refreshed_at = now
+            try:
+                devices = self.hal.list_devices()
+            except Exception as e:
+                print(f"DeviceManager Error: 刷新设备列表失败: {e}")
+                return False
+            new_devices = {device_id: device_type for device_id, device_type in devices.items()
+                           if device_id not in self._known_devices}
+            if not new_devices:
+                return False
+            self._known_devices = {**self._known_devices, **new_devices}
+        print(f"DeviceManager: 发现 {len(new_devices)} 个新设备: {list(new_devices)}")
+        if self.state_table is not None:
+            for device_id, device_type in new_devices.items():
+                try:
+                    self.state_table.register(device_id, device_type)
+                except Exception as e:
+                    print(f"DeviceManager Error: 无法在共享状态表中注册 {device_id}: {e}")
+        poller = self._poller
+        if poller is not None:
+            poller.add_sensors([device_id for device_id, device_type in new_devices.items()
+                                if device_type == "sensor_temp"])
+        return True
+
 # --- 测试代码 (保持不变，但会使用 ActualHAL) ---
 if __name__ == "__main__":
     print("测试 DeviceManager (使用 ActualHAL)...")
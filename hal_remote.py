@@ -0,0 +1,511 @@
+# hal_remote.py
+import functools
+import json
+import queue
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from hal_actual import DeviceConfigurationError
+
+class _PipelinedConnection:
+    """
+    到远程控制器 TCP 服务器的一个持久连接。
+    请求写出后不等待响应 (流水线)，读线程按发送顺序把每行响应交给对应的 Future。
+    连接出错或被对端关闭时，所有未完成的 Future 都以 ConnectionError 结束。
+    """
+    def __init__(self, address, timeout):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock.settimeout(None) # 读线程阻塞等待响应，调用者的超时由 Future 负责
+        self._pending = deque()     # 已发送、尚未收到响应的 Future (按发送顺序)
+        self._lock = threading.Lock()
+        self.closed = False
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def send(self, request, future):
+        """发送一个请求，响应 (字典) 将通过 future 返回。连接已关闭时返回 False。"""
+        data = (json.dumps(request) + "\n").encode('utf-8')
+        with self._lock:
+            if self.closed:
+                return False
+            self._pending.append(future)
+            try:
+                self.sock.sendall(data)
+                return True
+            except OSError as e:
+                error = e
+        # 发送失败 (可能只写出了一部分，连接上的数据流已不可用): 关闭连接，future 随之失败
+        self.close(ConnectionError(f"向 {self.address} 发送请求失败: {error}"))
+        return True
+
+    def _read_loop(self):
+        error = ConnectionError(f"远程控制器 {self.address} 关闭了连接")
+        try:
+            with self.sock.makefile('rb') as reader:
+                for line in reader:
+                    if not line.strip():
+                        continue
+                    response = json.loads(line.decode('utf-8'))
+                    with self._lock:
+                        future = self._pending.popleft() if self._pending else None
+                    if future is None:
+                        error = ConnectionError(f"远程控制器 {self.address} 返回了多余的响应")
+                        break
+                    future.set_result(response)
+        except (OSError, ValueError) as e:
+            error = ConnectionError(f"与远程控制器 {self.address} 的连接出错: {e}")
+        self.close(error)
+
+    def close(self, error=None):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self._pending)
+            self._pending.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        error = error or ConnectionError(f"与远程控制器 {self.address} 的连接已关闭")
+        for future in pending:
+            if not future.done():
+                future.set_exception(error)
+
+class RemoteHAL:
+    """
+    远程硬件抽象层：接口与 ActualHAL 相同 (read_device / write_device / list_devices)，
+    把设备操作转发给另一个控制器的 TCP 服务器 (main_controller.SmartHomeControllerTCPHandler)。
+    - 维护 pool_size 个持久连接，请求在连接上流水线发送，不为每个请求建立新连接
+    - 并发到达的请求由发送线程合并为一个 batch 命令 (最多 max_batch 个)，同一批次中
+      重复的只读请求 (同一设备的 get) 只发送一次
+    - 旧版本的控制器把一次 recv 当作一个完整的 JSON 请求，既不认识 batch 也不支持流水线：在第一个 batch 的响应
+      确认远程支持之前，以及确认不支持之后，每个连接同一时间只有一个请求在途 (不支持时逐个发送)
+    - 设备列表缓存 list_ttl 秒；获取失败时继续使用最近一次的列表到下一个 list_ttl，没有缓存时 LIST_RETRY_DELAY
+      秒内直接失败，不会每次调用都访问网络
+    所有远程错误都以 DeviceConfigurationError 抛出，与 ActualHAL 一致。
+    """
+    RECONNECT_DELAY = 1.0 # 连接失败后，在这段时间内不再重试连接 (快速失败)
+    LIST_RETRY_DELAY = 10.0 # 没有缓存的设备列表且获取失败后，在这段时间内直接失败
+
+    def __init__(self, host, port, pool_size=2, timeout=5.0, max_batch=32, list_ttl=60.0):
+        """
+        :param host: 远程控制器地址
+        :param port: 远程控制器 TCP 端口
+        :param pool_size: 持久连接数
+        :param timeout: 连接和单个请求的超时 (秒)
+        :param max_batch: 合并为一个 batch 命令的最大请求数 (1 表示不合并)
+        :param list_ttl: 设备列表的缓存时间 (秒)
+        """
+        if pool_size < 1 or max_batch < 1:
+            raise ValueError("pool_size 和 max_batch 必须至少为 1")
+        self.address = (host, port)
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.list_ttl = list_ttl
+        self._pool = [None] * pool_size # 只由发送线程访问
+        self._retry_at = 0.0
+        self._batch_supported = None    # None: 尚未确认；只有为 True 时才在连接上流水线发送
+        self._idle_cond = threading.Condition() # 有请求完成时通知 (等待空闲连接的发送线程)
+        self._queue = queue.Queue()     # (request, future)，None 表示停止
+        self._closed = False
+
+        self._devices = None
+        self._devices_fetched = 0.0
+        self._list_retry_at = 0.0
+        self._devices_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._messages = 0   # 实际发送的消息数 (一个 batch 计一次)
+        self._batched = 0    # 经 batch 命令发送的请求数
+        self._coalesced = 0  # 与同批次的相同请求合并、未单独发送的请求数
+        self._connects = 0
+
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._dispatcher.start()
+        print(f"RemoteHAL: 远程控制器 {host}:{port} (连接池 {pool_size}，批量上限 {max_batch})")
+
+    # --- ActualHAL 接口 ---
+    def read_device(self, device_id):
+        response = self._call({"command": "get", "device_id": device_id})
+        if not response.get("success"):
+            raise DeviceConfigurationError(f"远程控制器 {self._label}: {response.get('error')}")
+        return response["data"]
+
+    def write_device(self, device_id, state):
+        response = self._call({"command": "set", "device_id": device_id, "state": state})
+        if not response.get("success"):
+            print(f"RemoteHAL: 远程控制器 {self._label} 设置 {device_id} 失败: "
+                  f"{response.get('error') or response.get('message')}")
+        return bool(response.get("success"))
+
+    def list_devices(self):
+        with self._devices_lock:
+            now = time.monotonic()
+            if self._devices is not None and now - self._devices_fetched < self.list_ttl:
+                return dict(self._devices)
+            if self._devices is None and now < self._list_retry_at:
+                raise DeviceConfigurationError(f"远程控制器 {self._label} 不可用 (获取设备列表最近失败过)")
+        try:
+            response = self._call({"command": "list_devices"})
+            if not response.get("success"):
+                raise DeviceConfigurationError(f"远程控制器 {self._label}: {response.get('error')}")
+        except DeviceConfigurationError as e:
+            with self._devices_lock:
+                if self._devices is None:
+                    self._list_retry_at = time.monotonic() + self.LIST_RETRY_DELAY
+                    raise
+                # 继续使用缓存到下一个 list_ttl，期间不再访问网络
+                self._devices_fetched = time.monotonic()
+                print(f"RemoteHAL Warning: 无法刷新设备列表，{self.list_ttl:g} 秒内使用缓存: {e}")
+                return dict(self._devices)
+        with self._devices_lock:
+            self._devices = dict(response["data"])
+            self._devices_fetched = time.monotonic()
+            return dict(self._devices)
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {"address": self._label,
+                    "connections": sum(1 for conn in self._pool if conn is not None and not conn.closed),
+                    "pending": sum(conn.pending for conn in self._pool if conn is not None and not conn.closed),
+                    "requests": self._requests, "messages": self._messages,
+                    "batched": self._batched, "coalesced": self._coalesced,
+                    "connects": self._connects, "batch_supported": self._batch_supported}
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._dispatcher.join(timeout=self.timeout)
+        for conn in self._pool:
+            if conn is not None:
+                conn.close()
+
+    # --- 内部实现 ---
+    @property
+    def _label(self):
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def _call(self, request):
+        """把请求交给发送线程并等待响应"""
+        if self._closed:
+            raise DeviceConfigurationError(f"RemoteHAL {self._label} 已关闭")
+        future = Future()
+        with self._stats_lock:
+            self._requests += 1
+        self._queue.put((request, future))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise DeviceConfigurationError(f"远程控制器 {self._label} 响应超时 ({self.timeout:g} 秒)")
+        except (OSError, ValueError) as e:
+            raise DeviceConfigurationError(f"远程控制器 {self._label} 不可用: {e}")
+
+    def _dispatch_loop(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            items = [item]
+            # 取走已经排队的其他请求，与这个请求合并发送
+            while len(items) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+            self._send(items)
+        # 已关闭: 让仍在排队的请求立即失败
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].set_exception(ConnectionError("RemoteHAL 已关闭"))
+
+    def _send(self, items):
+        # 合并同一批次中相同的只读请求: [(请求, [等待该响应的 future, ...]), ...]
+        groups = []
+        index = {}
+        for request, future in items:
+            key = None
+            if request.get("command") in ("get", "list_devices"):
+                key = (request["command"], request.get("device_id"))
+            if key is not None and key in index:
+                groups[index[key]][1].append(future)
+                continue
+            if key is not None:
+                index[key] = len(groups)
+            groups.append((request, [future]))
+        with self._stats_lock:
+            self._coalesced += len(items) - len(groups)
+
+        pipelined = self._batch_supported is True
+        try:
+            conn = self._get_connection(wait_idle=not pipelined)
+        except OSError as e:
+            error = ConnectionError(f"无法连接远程控制器 {self._label}: {e}")
+            for _, futures in groups:
+                for future in futures:
+                    future.set_exception(error)
+            return
+
+        if len(groups) > 1 and self._batch_supported is not False:
+            message = {"command": "batch", "requests": [request for request, _ in groups]}
+            wire = Future()
+            wire.add_done_callback(self._notify_idle)
+            wire.add_done_callback(functools.partial(self._deliver_batch, groups, conn))
+            with self._stats_lock:
+                self._messages += 1
+                self._batched += len(groups)
+            if not conn.send(message, wire):
+                wire.set_exception(ConnectionError(f"与远程控制器 {self._label} 的连接已关闭"))
+            return
+        for index, (request, futures) in enumerate(groups):
+            if index and not pipelined:
+                try:
+                    conn = self._get_connection(wait_idle=True)
+                except OSError as e:
+                    error = ConnectionError(f"无法连接远程控制器 {self._label}: {e}")
+                    for future in futures:
+                        future.set_exception(error)
+                    continue
+            wire = Future()
+            wire.add_done_callback(self._notify_idle)
+            wire.add_done_callback(functools.partial(self._deliver, futures))
+            with self._stats_lock:
+                self._messages += 1
+            if not conn.send(request, wire):
+                wire.set_exception(ConnectionError(f"与远程控制器 {self._label} 的连接已关闭"))
+
+    def _get_connection(self, wait_idle=False):
+        """
+        返回未完成请求最少的连接，必要时 (重新) 建立连接。
+        wait_idle 为 True 时只返回没有在途请求的连接 (不流水线)，最多等待 timeout 秒。
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            for slot, conn in enumerate(self._pool):
+                if conn is not None and conn.closed:
+                    self._pool[slot] = None
+            if None in self._pool and time.monotonic() >= self._retry_at:
+                slot = self._pool.index(None)
+                try:
+                    self._pool[slot] = _PipelinedConnection(self.address, self.timeout)
+                    with self._stats_lock:
+                        self._connects += 1
+                except OSError:
+                    self._retry_at = time.monotonic() + self.RECONNECT_DELAY
+                    if all(conn is None for conn in self._pool):
+                        raise
+            live = [conn for conn in self._pool if conn is not None]
+            if not live:
+                raise ConnectionError("连接池为空，稍后重试")
+            conn = min(live, key=lambda conn: conn.pending)
+            if not wait_idle or conn.pending == 0:
+                return conn
+            with self._idle_cond:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionError(f"{self.timeout:g} 秒内没有空闲连接 (远程控制器不支持流水线)")
+                self._idle_cond.wait_for(lambda: any(conn.pending == 0 or conn.closed for conn in live),
+                                         timeout=remaining)
+
+    def _notify_idle(self, wire):
+        with self._idle_cond:
+            self._idle_cond.notify_all()
+
+    @staticmethod
+    def _deliver(futures, wire):
+        error = wire.exception()
+        for future in futures:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(wire.result())
+
+    def _deliver_batch(self, groups, conn, wire):
+        error = wire.exception()
+        if error is not None:
+            for _, futures in groups:
+                for future in futures:
+                    future.set_exception(error)
+            return
+        response = wire.result()
+        results = response.get("data") if response.get("success") else None
+        if not isinstance(results, list) or len(results) != len(groups):
+            # 旧版本的远程控制器不认识 batch 命令: 以后逐个发送，并把这一批重新排队。
+            # 它可能把超过一次 recv 的 batch 消息拆成多个 "请求" 并各自响应，这条连接上的响应顺序已不可信，关闭它
+            print(f"RemoteHAL Warning: 远程控制器 {self._label} 不支持 batch 命令 "
+                  f"({response.get('error')})，改为逐个发送。")
+            self._batch_supported = False
+            conn.close(ConnectionError(f"远程控制器 {self._label} 不支持 batch 命令"))
+            with self._stats_lock:
+                self._coalesced -= sum(len(futures) - 1 for _, futures in groups) # 重新排队后会再次合并计数
+            for request, futures in groups:
+                for future in futures:
+                    self._queue.put((request, future))
+            return
+        self._batch_supported = True # 支持 batch 的控制器按行分帧，可以流水线发送
+        for (_, futures), result in zip(groups, results):
+            for future in futures:
+                future.set_result(result)
+
+class CompositeHAL:
+    """
+    把多个 HAL 组合为一个 (前端控制器统一管理多层楼/多套房子)。
+    hals 为 {前缀: HAL}：设备 ID 以 "前缀:设备ID" 的形式对外暴露；前缀为 "" 的 HAL (通常是本机的 ActualHAL)
+    设备 ID 保持不变，已有的调度任务和规则无需修改。
+    """
+    def __init__(self, hals, separator=":"):
+        if not hals:
+            raise ValueError("CompositeHAL 至少需要一个 HAL")
+        self._hals = dict(hals)
+        self.separator = separator
+
+    def _resolve(self, device_id):
+        prefix, sep, local_id = device_id.partition(self.separator)
+        if sep and prefix and prefix in self._hals:
+            return self._hals[prefix], local_id
+        if "" in self._hals:
+            return self._hals[""], device_id
+        raise DeviceConfigurationError(f"设备ID '{device_id}' 不属于任何已配置的控制器")
+
+    def backend_of(self, device_id):
+        """设备所属 HAL 的前缀 (本机为 "")，DeviceManager 据此为每个后端使用独立的准入控制"""
+        prefix, sep, _ = device_id.partition(self.separator)
+        if sep and prefix and prefix in self._hals:
+            return prefix
+        if "" in self._hals:
+            return ""
+        raise DeviceConfigurationError(f"设备ID '{device_id}' 不属于任何已配置的控制器")
+
+    def read_device(self, device_id):
+        hal, local_id = self._resolve(device_id)
+        return hal.read_device(local_id)
+
+    def write_device(self, device_id, state):
+        hal, local_id = self._resolve(device_id)
+        return hal.write_device(local_id, state)
+
+    def list_devices(self):
+        """合并所有 HAL 的设备列表；某个 HAL 不可用时跳过它，不影响其他设备"""
+        devices = {}
+        for prefix, hal in self._hals.items():
+            try:
+                hal_devices = hal.list_devices()
+            except Exception as e:
+                print(f"CompositeHAL Warning: 无法获取 '{prefix}' 的设备列表，跳过: {e}")
+                continue
+            for device_id, device_type in hal_devices.items():
+                devices[f"{prefix}{self.separator}{device_id}" if prefix else device_id] = device_type
+        return devices
+
+    def get_stats(self):
+        return {prefix or "local": hal.get_stats() for prefix, hal in self._hals.items() if hasattr(hal, "get_stats")}
+
+    def close(self):
+        for hal in self._hals.values():
+            if hasattr(hal, "close"):
+                hal.close()
+
+
+# --- 测试代码: 两个本机控制器实例 (设备为普通文件) + 一个前端 DeviceManager ---
+if __name__ == "__main__":
+    import contextlib
+    import io
+    import os
+    import tempfile
+
+    import main_controller
+    from main_controller import ThreadingTCPServerWithManager, SmartHomeControllerTCPHandler
+    from device_manager import DeviceManager
+    from hal_actual import ActualHAL
+    from admission import PriorityGate
+
+    main_controller.TRUSTED_PEER_HOSTS.add("127.0.0.1") # 前端控制器不受每客户端限速
+    quiet = contextlib.redirect_stdout(io.StringIO())   # 各层的逐请求日志太多，测量时不输出
+
+    def start_floor(root, name):
+        os.makedirs(os.path.join(root, name))
+        config = {}
+        for device_id, device_type, initial in (("light_livingroom", "light", "off"), ("light_bedroom", "light", "off"),
+                                                ("sensor_temp_main", "sensor_temp", "21.5")):
+            path = os.path.join(root, name, device_id)
+            with open(path, "w") as f:
+                f.write(initial)
+            config[device_id] = {"path": path, "type": device_type}
+        with quiet:
+            manager = DeviceManager(ActualHAL(config))
+        server = ThreadingTCPServerWithManager(("127.0.0.1", 0), SmartHomeControllerTCPHandler, manager)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def naive_get(port, device_id):
+        """对比基线: 每个请求新建一个 TCP 连接"""
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            sock.sendall(json.dumps({"command": "get", "device_id": device_id}).encode('utf-8'))
+            return json.loads(sock.makefile('rb').readline())
+
+    def run_clients(read, num_threads=16, per_thread=100):
+        def worker(i):
+            for j in range(per_thread):
+                read(f"floor{1 + (i + j) % 2}:light_livingroom" if j % 3 else f"floor{1 + i % 2}:sensor_temp_main")
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(num_threads)]
+        start = time.perf_counter()
+        with quiet:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return num_threads * per_thread / (time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as root:
+        floors = {name: start_floor(root, name) for name in ("floor1", "floor2")}
+        ports = {name: server.server_address[1] for name, server in floors.items()}
+        hal = CompositeHAL({name: RemoteHAL("127.0.0.1", port, pool_size=2) for name, port in ports.items()})
+        with quiet:
+            front = DeviceManager(hal, backend_gates={name: PriorityGate(capacity=16) for name in ports})
+        print(f"前端设备列表: {sorted(front.list_all_devices())}")
+
+        with quiet:
+            ok = front.set_device_state("floor2:light_bedroom", "on")
+            state = front.get_device_state("floor2:light_bedroom")
+        with open(os.path.join(root, "floor2", "light_bedroom")) as f:
+            print(f"set floor2:light_bedroom on -> {ok}，远程设备文件内容: {f.read()!r}，前端读回: {state['state']}")
+        with quiet:
+            missing = front.get_device_state("floor3:light_bedroom")
+        print(f"不存在的前缀: {missing}")
+
+        naive = run_clients(lambda device_id: naive_get(ports[device_id.split(':')[0]], device_id.split(':')[1]))
+        pooled = run_clients(lambda device_id: front.get_device_state(device_id))
+        print(f"16 个并发客户端读取: 每请求新建连接 {naive:,.0f} 次/秒，RemoteHAL 连接池+流水线+批量 {pooled:,.0f} 次/秒")
+        for name, stats in hal.get_stats().items():
+            print(f"  {name}: {stats}")
+
+        with quiet:
+            front.close()
+            hal.close()
+        for server in floors.values():
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,227 @@
+# http_gateway.py
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from hal_actual import DeviceConfigurationError
+from admission import DeviceBusyError, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from profiler import profiler
+
+class SmartHomeHTTPServer(ThreadingHTTPServer):
+    """HTTP/1.1 网关服务器，与 TCP 服务器共用同一个 DeviceManager"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, device_manager):
+        super().__init__(server_address, SmartHomeHTTPRequestHandler)
+        self.device_manager = device_manager
+
+class SmartHomeHTTPRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP 网关请求处理 (HTTP/1.1，支持 keep-alive)。
+      GET  /devices                 列出设备 (list_devices)
+      GET  /devices/<id>            获取设备状态 (get)，ETag 为设备状态版本
+      PUT  /devices/<id>            设置设备状态 (set)，请求体 {"state": "on"} (也接受 POST)
+      GET  /status                  获取所有设备状态 (status_all)，ETag 为全屋状态版本
+      GET  /ping
+    GET /devices/<id> 和 /status 支持条件请求：If-None-Match 与当前版本一致时直接返回 304，不访问 HAL；
+    同时带 ?wait=<秒> 时为长轮询，阻塞到下一次状态变化 (或超时返回 304)。
+    响应体格式与 TCP 协议一致: {"success": ..., "data"/"message"/"error": ...}
+    """
+    protocol_version = "HTTP/1.1"
+    server_version = "SmartHomeGateway/1.0"
+    timeout = 60           # keep-alive 连接的空闲超时 (秒)
+    MAX_WAIT = 60.0        # 长轮询最长等待时间 (秒)
+    MAX_BODY = 64 * 1024
+
+    # --- 响应工具 ---
+    def _send_json(self, status, payload, etag=None, retry_after=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        if etag:
+            self.send_header("ETag", etag)
+        if retry_after:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_not_modified(self, etag):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _etag(self, key, version):
+        """ETag 为 "<实例标识>-<设备 ID 或 house>-<版本>" (实例标识见 DeviceManager.instance_id)"""
+        return f'"{self.server.device_manager.instance_id}-{key}-{version}"'
+
+    def _client_etags(self):
+        """解析 If-None-Match 头，返回 ETag 集合 (忽略弱校验前缀 W/)"""
+        header = self.headers.get("If-None-Match")
+        if not header:
+            return set()
+        tags = {tag.strip() for tag in header.split(",")}
+        return {tag[2:] if tag.startswith("W/") else tag for tag in tags}
+
+    def _send_busy(self, error):
+        """过载时快速失败: 503 + Retry-After"""
+        self._send_json(503, {"success": False, "busy": True, "error": f"busy: {error}"}, retry_after=1)
+
+    @property
+    def _client_id(self):
+        return f"http:{self.client_address[0]}"
+
+    def _wait_seconds(self, query):
+        try:
+            return max(0.0, min(float(query.get("wait", ["0"])[0]), self.MAX_WAIT))
+        except ValueError:
+            return 0.0
+
+    def handle(self):
+        try:
+            super().handle()
+        finally:
+            profiler.release() # 连接处理线程结束，关闭 cprofile 模式下本线程的 Profile
+
+    def handle_one_request(self):
+        profiler.checkpoint()
+        super().handle_one_request()
+
+    def log_message(self, format, *args):
+        print(f"HTTP Gateway: {self.client_address[0]} - {format % args}")
+
+    # --- 路由 ---
+    def _route(self):
+        parts = urlsplit(self.path)
+        segments = [s for s in parts.path.split("/") if s]
+        return segments, parse_qs(parts.query)
+
+    def do_GET(self):
+        segments, query = self._route()
+        device_manager = self.server.device_manager
+        try:
+            if segments == ["ping"]:
+                self._send_json(200, {"success": True, "message": "pong"})
+            elif segments == ["devices"]:
+                self._send_json(200, {"success": True, "data": device_manager.list_all_devices()})
+            elif len(segments) == 2 and segments[0] == "devices":
+                self._get_device(segments[1], query)
+            elif segments == ["status"]:
+                self._get_status(query)
+            else:
+                self._send_json(404, {"success": False, "error": f"未知路径: {self.path}"})
+        except DeviceConfigurationError as e:
+            self._send_json(404, {"success": False, "error": f"设备相关错误: {e}"})
+        except DeviceBusyError as e:
+            self._send_busy(e)
+        except (ConnectionResetError, BrokenPipeError):
+            raise
+        except Exception as e:
+            print(f"HTTP Gateway Error: 处理 GET {self.path} 时出错: {e}")
+            self._send_json(500, {"success": False, "error": f"处理请求时发生内部错误: {str(e)}"})
+
+    def _get_device(self, device_id, query):
+        device_manager = self.server.device_manager
+        version = device_manager.get_device_version(device_id)
+        etag = self._etag(device_id, version)
+        # 只有已知设备才有版本号，304/长轮询路径不需要 (也不应为此访问 HAL) 检查设备列表
+        if version and etag in self._client_etags():
+            wait = self._wait_seconds(query)
+            if not wait:
+                self._send_not_modified(etag) # 客户端已是最新版本，不访问 HAL
+                return
+            version = device_manager.wait_for_change(device_id, version, timeout=wait)
+            etag = self._etag(device_id, version)
+            if etag in self._client_etags():
+                self._send_not_modified(etag) # 长轮询超时，没有变化
+                return
+            # 变化刚由 DeviceManager 记录，缓存即最新状态
+            state_info = device_manager.get_cached_state(device_id)
+        else:
+            if not device_manager.has_device(device_id):
+                self._send_json(404, {"success": False, "error": f"设备 {device_id} 未找到"})
+                return
+            state_info = device_manager.get_device_state(device_id, priority=PRIORITY_INTERACTIVE,
+                                                         client_id=self._client_id)
+            version = device_manager.get_device_version(device_id)
+            etag = self._etag(device_id, version)
+        if state_info:
+            self._send_json(200, {"success": True, "data": state_info}, etag=etag)
+        else:
+            self._send_json(502, {"success": False, "error": f"设备 {device_id} 获取失败"})
+
+    def _get_status(self, query):
+        device_manager = self.server.device_manager
+        version = device_manager.get_house_version()
+        etag = self._etag("house", version)
+        if version and etag in self._client_etags():
+            wait = self._wait_seconds(query)
+            if not wait:
+                self._send_not_modified(etag)
+                return
+            version = device_manager.wait_for_change(None, version, timeout=wait)
+            etag = self._etag("house", version)
+            if etag in self._client_etags():
+                self._send_not_modified(etag)
+                return
+            # 长轮询唤醒后从缓存返回全屋状态，不逐个访问 HAL
+            all_status = {device_id: device_manager.get_cached_state(device_id)
+                          for device_id in device_manager.list_all_devices(refresh=False)}
+        else:
+            all_status = device_manager.get_all_devices_status(priority=PRIORITY_BULK, client_id=self._client_id)
+            etag = self._etag("house", device_manager.get_house_version())
+        self._send_json(200, {"success": True, "data": all_status}, etag=etag)
+
+    def do_PUT(self):
+        segments, _ = self._route()
+        if len(segments) != 2 or segments[0] != "devices":
+            self._send_json(404, {"success": False, "error": f"未知路径: {self.path}"})
+            return
+        device_id = segments[1]
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if not 0 < length <= self.MAX_BODY:
+            self.close_connection = True # 无法确定请求体边界，不能复用连接
+            self._send_json(400, {"success": False, "error": "请求需要 JSON 请求体 {\"state\": ...}"})
+            return
+        try:
+            request_json = json.loads(self.rfile.read(length))
+            state = request_json.get("state")
+        except (ValueError, AttributeError):
+            self._send_json(400, {"success": False, "error": "无效的 JSON 格式"})
+            return
+        if state is None:
+            self._send_json(400, {"success": False, "error": "请求体需要 'state' 参数"})
+            return
+        device_manager = self.server.device_manager
+        try:
+            if not device_manager.has_device(device_id):
+                self._send_json(404, {"success": False, "error": f"设备 {device_id} 未找到"})
+                return
+            success = device_manager.set_device_state(device_id, state, priority=PRIORITY_INTERACTIVE,
+                                                      client_id=self._client_id)
+        except DeviceConfigurationError as e:
+            self._send_json(404, {"success": False, "error": f"设备相关错误: {e}"})
+            return
+        except DeviceBusyError as e:
+            self._send_busy(e)
+            return
+        except (ConnectionResetError, BrokenPipeError):
+            raise
+        except Exception as e:
+            print(f"HTTP Gateway Error: 处理 PUT {self.path} 时出错: {e}")
+            self._send_json(500, {"success": False, "error": f"处理请求时发生内部错误: {str(e)}"})
+            return
+        if success:
+            version = device_manager.get_device_version(device_id)
+            self._send_json(200, {"success": True, "message": f"设备 {device_id} 设置为 {state}"},
+                            etag=self._etag(device_id, version))
+        else:
+            self._send_json(409, {"success": False, "error": f"设置设备 {device_id} 失败"})
+
+    do_POST = do_PUT
@@ -8,11 +8,24 @@ import json
 import sys
 import shlex
 import signal # 导入信号处理模块
+import os
+import socket
+import argparse
 
 # 从之前的模块导入类
 # from hal_mock import MockHAL, DeviceNotFoundError # 旧的
 from hal_actual import ActualHAL, DeviceConfigurationError # 新的
 from device_manager import DeviceManager
+from state_journal import StateJournal
+from sensor_rollup import SensorRollupStore, RESOLUTIONS
+from rules_engine import RulesEngine
+from shm_state_table import SharedStateTable
+from shm_state_reader import StateTableError
+from manager_ipc import DeviceManagerIPCServer, DeviceManagerProxy
+from http_gateway import SmartHomeHTTPServer
+from hal_remote import RemoteHAL, CompositeHAL
+from profiler import profiler
+from admission import PriorityGate, DeviceBusyError, PRIORITY_SCHEDULED, PRIORITY_INTERACTIVE, PRIORITY_BULK
 
 # 同样，将 DeviceNotFoundError 映射到 DeviceConfigurationError
 DeviceNotFoundError = DeviceConfigurationError
@@ -25,6 +38,62 @@ DEVICE_CONFIG = {
     "sensor_temp_main": {"path": "/dev/sensor_temp_main", "type": "sensor_temp"},
 }
 
+# --- 状态日志配置 (重启后恢复设备状态和传感器历史) ---
+JOURNAL_DIR = "./smart_home_data"
+JOURNAL_DURABILITY = "batch"   # none / batch / always，见 StateJournal.DURABILITY_MODES
+JOURNAL_FSYNC_INTERVAL = 1.0   # batch 模式下的 fsync 间隔 (秒)
+JOURNAL_SNAPSHOT_INTERVAL = 300.0 # 快照间隔 (秒)
+
+# --- 传感器长期汇总 (分钟/小时粒度的 min/max/avg/count 列文件，见 sensor_rollup.py) ---
+ROLLUP_DIR = "./smart_home_data/rollups" # 设为 None 则不记录
+
+# --- 共享内存状态表 (本机进程通过 shm_state_reader.py 无锁读取设备状态) ---
+SHM_STATE_PATH = "/dev/shm/smart_home_state" # 设为 None 则不发布
+SHM_STATE_CAPACITY = 256
+
+# --- 多进程服务器模式 (--workers N) ---
+# N 个工作进程通过 SO_REUSEPORT 共同监听同一端口，设备 I/O 由主进程 (HAL 进程) 独占，
+# 工作进程经 Unix 域套接字 IPC 访问主进程的 DeviceManager
+IPC_SOCKET_PATH = "/tmp/smart_home_hal.sock"
+
+# --- HTTP 网关 (供 Web 仪表盘使用，见 http_gateway.py) ---
+HTTP_PORT = 8080 # 设为 None 则不启动
+
+# --- 后台自适应传感器轮询 (见 sensor_poller.py) ---
+SENSOR_POLL_MIN_INTERVAL = 5.0    # 温度变化时的最短轮询间隔 (秒)
+SENSOR_POLL_MAX_INTERVAL = 120.0  # 温度稳定时的最长轮询间隔 (秒)
+SENSOR_POLL_CHANGE_THRESHOLD = 0.3 # 被视为 "正在变化" 的温度变化量 (度)
+
+# --- 准入控制 (见 admission.py) ---
+ADMISSION_MAX_QUEUE = {PRIORITY_SCHEDULED: 100, PRIORITY_INTERACTIVE: 50, PRIORITY_BULK: 20} # 各优先级最大排队数
+CLIENT_RATE_LIMIT = 20.0  # 每个网络客户端每秒请求数
+CLIENT_BURST = 40.0       # 每个网络客户端允许的突发请求数
+
+# --- 多控制器 (每层楼一个控制器，前端控制器通过 hal_remote.RemoteHAL 统一管理) ---
+# {前缀: (主机, 端口)}，远程设备以 "前缀:设备ID" 的形式出现在本控制器中；本机设备 ID 不变
+REMOTE_CONTROLLERS = {
+    # "floor2": ("192.168.1.12", 9998),
+}
+REMOTE_POOL_SIZE = 2          # 每个远程控制器的持久连接数
+REMOTE_HAL_CONCURRENCY = 16   # 每个远程控制器同时转发的最大操作数 (请求经流水线/批量合并转发)；本机设备仍串行访问
+# 上级 (前端) 控制器的地址：来自这些主机的 TCP 请求不受 CLIENT_RATE_LIMIT 限速
+TRUSTED_PEER_HOSTS = set()
+
+# --- 运行时分析 (CLI / TCP 的 profile 命令，见 profiler.py) ---
+PROFILE_DIR = "./smart_home_data/profiles" # 分析结果文件目录
+
+# --- 自动化规则 (事件驱动，见 rules_engine.py) ---
+# when: 条件列表 (op: > >= < <= == !=，hysteresis 为回差)；match: all/any
+# then: 条件成立 (并持续 debounce 秒) 时执行的动作；otherwise: 条件恢复时执行的动作 (可选)
+RULES_CONFIG = [
+    {
+        "name": "kitchen_socket_overheat",
+        "when": [{"device_id": "sensor_temp_main", "op": ">", "value": 30, "hysteresis": 0.5}],
+        "then": [{"device_id": "socket_kitchen", "state": "off"}],
+        "debounce": 10,
+    },
+]
+
 # --- 全局停止事件 ---
 stop_event = threading.Event()
 
@@ -42,78 +111,72 @@ class ThreadingTCPServerWithManager(socketserver.ThreadingTCPServer):
         self.device_manager = device_manager
         self.allow_reuse_address = True # 允许地址重用
 
+class ReusePortTCPServer(ThreadingTCPServerWithManager):
+    """多个工作进程绑定同一端口，由内核在它们之间分发新连接 (SO_REUSEPORT)"""
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
 class SmartHomeControllerTCPHandler(socketserver.BaseRequestHandler):
-    # ... (代码与之前相同) ...
+    """
+    TCP JSON 协议处理。每个请求是一个 JSON 对象，以换行结尾；响应同样是一行 JSON，按请求顺序返回，
+    因此客户端可以在一个连接上连续发送多个请求而不必等待响应 (流水线，见 hal_remote.RemoteHAL)。
+    为兼容旧客户端，没有换行但已是完整 JSON 的数据也按一个请求处理。
+    """
+    MAX_REQUEST_SIZE = 64 * 1024 # 单个请求的最大字节数
+    MAX_BATCH = 256              # batch 命令最多包含的子请求数
+
     def handle(self):
         client_address = self.client_address
         print(f"Network Server: 接受来自 {client_address} 的连接。")
         device_manager = self.server.device_manager # 从 server 获取 manager
+        # 按客户端 IP 限速；TRUSTED_PEER_HOSTS 中的上级控制器不限速
+        client_id = None if client_address[0] in TRUSTED_PEER_HOSTS else f"tcp:{client_address[0]}"
+        buffer = b""
         try:
             while not stop_event.is_set(): # 检查全局停止事件
+                profiler.checkpoint()
                 # 设置超时，以便在空闲时也能检查 stop_event
                 self.request.settimeout(1.0)
                 try:
-                    data_bytes = self.request.recv(1024).strip()
-                    if not data_bytes:
+                    chunk = self.request.recv(4096)
+                    if not chunk:
                         print(f"Network Server: 来自 {client_address} 的连接已关闭。")
                         break
                 except socketserver.socket.timeout:
                      continue # 超时后继续循环检查 stop_event
 
-                data_str = data_bytes.decode('utf-8')
-                print(f"Network Server: 收到来自 {client_address} 的原始数据: {data_str}")
-                response = {}
-                try:
-                    request_json = json.loads(data_str)
-                    command = request_json.get('command')
-                    # --- JSON 命令处理逻辑 ---
-                    if command == 'set':
-                        device_id = request_json.get('device_id')
-                        state = request_json.get('state')
-                        if device_id and state is not None:
-                             # 调用 device_manager 处理
-                             success = device_manager.set_device_state(device_id, state)
-                             response = {"success": success, "message": f"设备 {device_id} 设置为 {state}" if success else f"设置设备 {device_id} 失败"}
-                        else: response = {"success": False, "error": "命令 'set' 需要 'device_id' 和 'state' 参数"}
-
-                    elif command == 'get':
-                        device_id = request_json.get('device_id')
-                        if device_id:
-                            # 调用 device_manager 处理
-                            state_info = device_manager.get_device_state(device_id)
-                            if state_info:
-                                 # 转换时间戳以便 JSON 序列化 (可选)
-                                 # state_info['last_updated_str'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state_info['last_updated']))
-                                 response = {"success": True, "data": state_info}
-                            else:
-                                 response = {"success": False, "error": f"设备 {device_id} 未找到或获取失败"}
-                        else: response = {"success": False, "error": "命令 'get' 需要 'device_id' 参数"}
-
-                    elif command == 'status_all':
-                         # 调用 device_manager 处理
-                        all_status = device_manager.get_all_devices_status()
-                        # 可以添加时间戳转换
-                        response = {"success": True, "data": all_status}
-
-                    elif command == 'list_devices':
-                         # 调用 device_manager 处理
-                        devices = device_manager.list_all_devices()
-                        response = {"success": True, "data": devices}
-
-                    elif command == 'ping': response = {"success": True, "message": "pong"}
-                    else: response = {"success": False, "error": f"未知命令: {command}"}
-
-                except json.JSONDecodeError: response = {"success": False, "error": "无效的 JSON 格式"}
-                except DeviceNotFoundError as e: # 处理设备未找到或配置错误
-                     response = {"success": False, "error": f"设备相关错误: {e}"}
-                except Exception as e:
-                     print(f"Network Server Error: 处理命令时出错: {e}") # 打印详细错误
-                     response = {"success": False, "error": f"处理请求时发生内部错误: {str(e)}"}
-
-                # 发送响应
-                response_str = json.dumps(response) + "\n"
-                self.request.sendall(response_str.encode('utf-8'))
-                print(f"Network Server: 已发送响应给 {client_address}: {response_str.strip()}")
+                buffer += chunk
+                responses = []
+                while buffer:
+                    frame_start = time.perf_counter()
+                    line, newline, rest = buffer.partition(b"\n")
+                    if newline:
+                        buffer = rest
+                    else:
+                        # 没有换行: 旧客户端一次发送一个完整的 JSON；否则等待更多数据
+                        try:
+                            json.loads(buffer.decode('utf-8'))
+                        except ValueError:
+                            if len(buffer) > self.MAX_REQUEST_SIZE:
+                                responses.append(json.dumps({"success": False, "error": "请求过大"}) + "\n")
+                                buffer = b""
+                            break
+                        buffer = b""
+                    if line.strip():
+                        # trace 模式下记录各阶段耗时 (准入等待和 HAL I/O 由 DeviceManager 记录)
+                        trace = profiler.trace_begin(framing=time.perf_counter() - frame_start)
+                        command, response = self._handle_line(line, device_manager, client_id)
+                        serialize_start = time.perf_counter()
+                        responses.append(json.dumps(response) + "\n")
+                        profiler.trace_stage("serialization", time.perf_counter() - serialize_start)
+                        profiler.trace_end(trace, f"tcp:{command}")
+
+                if responses:
+                    # 同一次 recv 收到的多个请求的响应合并为一次发送
+                    self.request.sendall("".join(responses).encode('utf-8'))
+                    print(f"Network Server: 已发送 {len(responses)} 个响应给 {client_address}")
 
         except socketserver.socket.timeout:
             # 这个异常理论上在内部循环处理了，但外部也捕获一下
@@ -124,15 +187,201 @@ class SmartHomeControllerTCPHandler(socketserver.BaseRequestHandler):
             # 捕获处理循环中的其他潜在错误
             print(f"Network Server Error: 处理来自 {client_address} 的连接时发生意外错误: {e}")
         finally:
+            profiler.release()
             print(f"Network Server: 结束与 {client_address} 的连接处理。")
             self.request.close()
 
+    def _handle_line(self, line, device_manager, client_id):
+        """解析并处理一行请求，返回 (命令名, 响应字典)"""
+        try:
+            data_str = line.decode('utf-8').strip()
+            print(f"Network Server: 收到来自 {self.client_address} 的原始数据: {data_str}")
+            parse_start = time.perf_counter()
+            request_json = json.loads(data_str)
+            profiler.trace_stage("json_parse", time.perf_counter() - parse_start)
+        except ValueError: # 包括 JSONDecodeError 和 UnicodeDecodeError
+            return "invalid", {"success": False, "error": "无效的 JSON 格式"}
+        if not isinstance(request_json, dict):
+            return "invalid", {"success": False, "error": "无效的 JSON 格式"}
+
+        command = str(request_json.get('command'))
+        if command == 'batch':
+            # 批量请求: 依次处理每个子请求，按顺序返回各自的响应 (子请求各自计入限速)
+            requests = request_json.get('requests')
+            if not isinstance(requests, list):
+                return command, {"success": False, "error": "命令 'batch' 需要 'requests' 列表参数"}
+            if len(requests) > self.MAX_BATCH:
+                return command, {"success": False, "error": f"batch 最多包含 {self.MAX_BATCH} 个请求"}
+            results = []
+            for sub_request in requests:
+                if not isinstance(sub_request, dict) or sub_request.get('command') == 'batch':
+                    results.append({"success": False, "error": "无效的子请求"})
+                else:
+                    results.append(self._handle_command(sub_request, device_manager, client_id))
+            return command, {"success": True, "data": results}
+        return command, self._handle_command(request_json, device_manager, client_id)
+
+    def _handle_command(self, request_json, device_manager, client_id):
+        """处理一个 JSON 命令，返回响应字典"""
+        response = {}
+        try:
+            command = request_json.get('command')
+            # --- JSON 命令处理逻辑 ---
+            if command == 'set':
+                device_id = request_json.get('device_id')
+                state = request_json.get('state')
+                if device_id and state is not None:
+                     # 调用 device_manager 处理
+                     success = device_manager.set_device_state(device_id, state, priority=PRIORITY_INTERACTIVE, client_id=client_id)
+                     response = {"success": success, "message": f"设备 {device_id} 设置为 {state}" if success else f"设置设备 {device_id} 失败"}
+                else: response = {"success": False, "error": "命令 'set' 需要 'device_id' 和 'state' 参数"}
+
+            elif command == 'get':
+                device_id = request_json.get('device_id')
+                if device_id:
+                    # 调用 device_manager 处理
+                    state_info = device_manager.get_device_state(device_id, priority=PRIORITY_INTERACTIVE, client_id=client_id)
+                    if state_info:
+                         # 转换时间戳以便 JSON 序列化 (可选)
+                         # state_info['last_updated_str'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state_info['last_updated']))
+                         response = {"success": True, "data": state_info}
+                    else:
+                         response = {"success": False, "error": f"设备 {device_id} 未找到或获取失败"}
+                else: response = {"success": False, "error": "命令 'get' 需要 'device_id' 参数"}
+
+            elif command == 'status_all':
+                 # 调用 device_manager 处理
+                all_status = device_manager.get_all_devices_status(priority=PRIORITY_BULK, client_id=client_id)
+                # 可以添加时间戳转换
+                response = {"success": True, "data": all_status}
+
+            elif command == 'list_devices':
+                 # 调用 device_manager 处理
+                devices = device_manager.list_all_devices()
+                response = {"success": True, "data": devices}
+
+            elif command == 'stats':
+                response = {"success": True, "data": device_manager.get_stats()}
+
+            elif command == 'rollup':
+                # 传感器长期汇总: {"device_id": ..., "resolution": "hour"/"minute", "days": 90} 或 "start"/"end" 时间戳
+                device_id = request_json.get('device_id')
+                resolution = RESOLUTIONS.get(request_json.get('resolution', 'hour'))
+                if not device_id or resolution is None:
+                    response = {"success": False, "error": "命令 'rollup' 需要 'device_id' 参数，resolution 可选 hour/minute"}
+                else:
+                    try:
+                        end = float(request_json.get('end', time.time()))
+                        start = float(request_json['start']) if 'start' in request_json \
+                            else end - float(request_json.get('days', 1)) * 86400
+                    except (TypeError, ValueError):
+                        response = {"success": False, "error": "'start'/'end'/'days' 需要是数字"}
+                    else:
+                        result = device_manager.get_sensor_rollup(device_id, start, end, resolution)
+                        if result is None:
+                            response = {"success": False, "error": "传感器汇总未启用"}
+                        else:
+                            response = {"success": True, "data": result}
+
+            elif command == 'profile':
+                # 运行时分析: {"action": "start", "mode": "sample"/"cprofile"/"trace"} / {"action": "stop"} / {"action": "status"}
+                # 结果写入 PROFILE_DIR (网络客户端不能指定路径)；多进程模式下分析的是处理该连接的工作进程
+                action = request_json.get('action', 'status')
+                try:
+                    if action == 'start':
+                        path = profiler.start(request_json.get('mode', 'sample'), output_dir=PROFILE_DIR,
+                                              interval=float(request_json.get('interval', 0.005)))
+                        response = {"success": True, "message": f"分析已开始，结果将写入 {path}"}
+                    elif action == 'stop':
+                        response = {"success": True, "data": profiler.stop()}
+                    elif action == 'status':
+                        response = {"success": True, "data": profiler.status()}
+                    else:
+                        response = {"success": False, "error": f"未知的 profile 操作: {action}"}
+                except (ValueError, TypeError) as e:
+                    response = {"success": False, "error": str(e)}
+
+            elif command == 'ping': response = {"success": True, "message": "pong"}
+            else: response = {"success": False, "error": f"未知命令: {command}"}
+
+        except DeviceBusyError as e: # 过载时快速失败，客户端应稍后重试
+             response = {"success": False, "busy": True, "error": f"busy: {e}"}
+        except DeviceNotFoundError as e: # 处理设备未找到或配置错误
+             response = {"success": False, "error": f"设备相关错误: {e}"}
+        except Exception as e:
+             print(f"Network Server Error: 处理命令时出错: {e}") # 打印详细错误
+             response = {"success": False, "error": f"处理请求时发生内部错误: {str(e)}"}
+        return response
+
+
+# --- 多进程服务器工作进程 ---
+def run_server_worker(worker_id, host, port, ipc_address, authkey, state_table_path):
+    """
+    工作进程入口 (在 fork 出的子进程中运行，永不返回)。
+    运行一个 SO_REUSEPORT 的 TCP 服务器，设备操作通过 DeviceManagerProxy 转发给 HAL 进程。
+    """
+    exit_code = 0
+    server = None
+    try:
+        print(f"Worker {worker_id} (pid {os.getpid()}): 启动，监听 {host}:{port}...")
+        proxy = DeviceManagerProxy(ipc_address, authkey, state_table_path=state_table_path)
+        server = ReusePortTCPServer((host, port), SmartHomeControllerTCPHandler, proxy)
+        server.daemon_threads = True
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        stop_event.wait() # 由 SIGTERM/SIGINT 设置
+    except Exception as e:
+        print(f"Worker {worker_id} Error: {e}")
+        exit_code = 1
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        print(f"Worker {worker_id} (pid {os.getpid()}): 已退出。")
+        sys.stdout.flush()
+        os._exit(exit_code) # 不能回到父进程的主流程
+
+def start_server_workers(num_workers, host, port, ipc_address, authkey, state_table_path):
+    """fork 出 num_workers 个服务器工作进程，返回它们的 pid 列表"""
+    sys.stdout.flush() # 避免子进程重复输出父进程缓冲区中的内容
+    pids = []
+    for worker_id in range(num_workers):
+        pid = os.fork()
+        if pid == 0:
+            run_server_worker(worker_id, host, port, ipc_address, authkey, state_table_path)
+        pids.append(pid)
+    print(f"Main Controller: 已启动 {num_workers} 个服务器工作进程: {pids}")
+    return pids
+
+def stop_server_workers(pids, timeout=5.0):
+    """向工作进程发送 SIGTERM 并等待退出，超时则 SIGKILL"""
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.time() + timeout
+    remaining = list(pids)
+    while remaining and time.time() < deadline:
+        for pid in list(remaining):
+            try:
+                done_pid, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done_pid = pid
+            if done_pid:
+                remaining.remove(pid)
+        time.sleep(0.05)
+    for pid in remaining:
+        print(f"Main Controller Warning: 工作进程 {pid} 未能及时退出，强制结束。")
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
 
 # --- 任务函数 (逻辑不变, 但依赖的 manager 现在使用 ActualHAL) ---
 def set_device_task(device_manager: DeviceManager, device_id: str, state: str):
     print(f"Scheduler: 触发任务 - 设置设备 {device_id} 为 {state}")
     try:
-        success = device_manager.set_device_state(device_id, state)
+        success = device_manager.set_device_state(device_id, state, priority=PRIORITY_SCHEDULED)
         if not success:
             print(f"Scheduler Warning: 设置设备 {device_id} 状态为 {state} 失败。")
     except Exception as e:
@@ -141,7 +390,7 @@ def set_device_task(device_manager: DeviceManager, device_id: str, state: str):
 def read_sensor_task(device_manager: DeviceManager, device_id: str):
     print(f"Scheduler: 触发任务 - 读取传感器 {device_id}")
     try:
-        state_info = device_manager.get_device_state(device_id)
+        state_info = device_manager.get_device_state(device_id, priority=PRIORITY_SCHEDULED)
         if state_info:
             current_time_str = time.strftime('%H:%M:%S', time.localtime(state_info['last_updated']))
             print(f"Scheduler Info: 传感器 {device_id} 当前状态: {state_info['state']} (读取于 {current_time_str})")
@@ -154,12 +403,12 @@ def read_sensor_task(device_manager: DeviceManager, device_id: str):
 def toggle_light_task(device_manager: DeviceManager, device_id: str):
      print(f"Scheduler: 触发任务 - 切换设备 {device_id} 状态")
      try:
-          current_state_info = device_manager.get_device_state(device_id)
+          current_state_info = device_manager.get_device_state(device_id, priority=PRIORITY_SCHEDULED)
           if current_state_info:
                current_state = current_state_info['state']
                next_state = "off" if current_state == "on" else "on"
                print(f"Scheduler: 正在将 {device_id} 从 {current_state} 切换到 {next_state}")
-               success = device_manager.set_device_state(device_id, next_state)
+               success = device_manager.set_device_state(device_id, next_state, priority=PRIORITY_SCHEDULED)
                if not success:
                     print(f"Scheduler Warning: 切换设备 {device_id} 状态失败。")
           else:
@@ -172,6 +421,7 @@ def toggle_light_task(device_manager: DeviceManager, device_id: str):
 def run_scheduler(stop_event: threading.Event):
     print("Scheduler: 调度器线程已启动，每秒检查一次任务。")
     while not stop_event.is_set():
+        profiler.checkpoint()
         try:
             schedule.run_pending()
         except Exception as e:
@@ -184,7 +434,7 @@ def run_scheduler(stop_event: threading.Event):
 
 
 # --- CLI 运行函数 (修改以更好地处理退出) ---
-def run_cli(device_manager: DeviceManager, stop_event: threading.Event):
+def run_cli(device_manager: DeviceManager, stop_event: threading.Event, rules_engine: RulesEngine = None):
     """运行命令行界面，接收用户输入并执行命令"""
     print("CLI: 命令行界面已启动。输入 'help' 获取帮助，输入 'exit' 或按 Ctrl+C 退出。")
     while not stop_event.is_set():
@@ -196,6 +446,7 @@ def run_cli(device_manager: DeviceManager, stop_event: threading.Event):
             command_line = input("Controller> ")
             if stop_event.is_set(): # 在 input 返回后再次检查
                  break
+            profiler.checkpoint()
 
             if not command_line:
                 continue
@@ -220,6 +471,12 @@ def run_cli(device_manager: DeviceManager, stop_event: threading.Event):
                 print("  open <device_id>              - 打开设备 (如灯、插座)")
                 print("  close <device_id>             - 关闭设备 (如灯、插座)")
                 print("  set <device_id> <state>       - 设置设备状态 (通用，小心使用)")
+                print("  history <device_id> [分钟]    - 显示传感器最近的历史读数 (默认 60 分钟)")
+                print("  rollup <device_id> [hour|minute] [天数] - 显示传感器的长期汇总 (默认最近 1 天每小时)")
+                print("  rules                         - 列出自动化规则及其状态")
+                print("  stats                         - 显示准入控制、缓存和传感器轮询统计")
+                print("  profile start [sample|cprofile|trace] [文件] - 开始运行时分析 (默认 sample)")
+                print("  profile stop / status         - 停止分析并写出结果 / 查看分析状态")
                 print("  exit / quit                   - 关闭控制器")
 
             elif command == "list":
@@ -237,7 +494,8 @@ def run_cli(device_manager: DeviceManager, stop_event: threading.Event):
                 if not args:
                     print("用法: status <device_id> 或 status all")
                 elif args[0].lower() == "all":
-                    all_status = device_manager.get_all_devices_status()
+                    # CLI 是交互式操作，不与网络客户端的批量读取排在同一通道
+                    all_status = device_manager.get_all_devices_status(priority=PRIORITY_INTERACTIVE)
                     print("所有设备状态:")
                     if not all_status:
                          print("  (无法获取任何设备状态)")
@@ -284,6 +542,114 @@ def run_cli(device_manager: DeviceManager, stop_event: threading.Event):
                      print(f"命令执行 {'成功' if success else '失败'}")
 
 
+            elif command == "history":
+                if len(args) not in (1, 2): print("用法: history <device_id> [分钟]")
+                else:
+                    device_id = args[0]
+                    minutes = float(args[1]) if len(args) == 2 else 60
+                    readings = device_manager.get_sensor_history(device_id, since=time.time() - minutes * 60)
+                    if not readings:
+                        print(f"设备 {device_id} 在最近 {minutes:g} 分钟内没有历史读数。")
+                    else:
+                        print(f"设备 {device_id} 最近 {minutes:g} 分钟的 {len(readings)} 条读数:")
+                        for ts, value in readings[-20:]: # 只显示最后 20 条
+                            print(f"  - {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))}: {value}")
+
+            elif command == "rollup":
+                if not 1 <= len(args) <= 3 or (len(args) > 1 and args[1] not in RESOLUTIONS):
+                    print("用法: rollup <device_id> [hour|minute] [天数]")
+                else:
+                    device_id = args[0]
+                    resolution_name = args[1] if len(args) > 1 else "hour"
+                    days = float(args[2]) if len(args) > 2 else 1
+                    now = time.time()
+                    query_start = time.perf_counter()
+                    result = device_manager.get_sensor_rollup(device_id, now - days * 86400, now, RESOLUTIONS[resolution_name])
+                    elapsed_ms = (time.perf_counter() - query_start) * 1000
+                    if result is None:
+                        print("传感器汇总未启用。")
+                    elif not result["timestamps"]:
+                        print(f"设备 {device_id} 在最近 {days:g} 天内没有汇总数据。")
+                    else:
+                        summary = result["summary"]
+                        print(f"设备 {device_id} 最近 {days:g} 天 {summary['buckets']} 个{'小时' if resolution_name == 'hour' else '分钟'}: "
+                              f"平均 {summary['avg']:.2f}，最低 {summary['min']}，最高 {summary['max']}，"
+                              f"共 {summary['count']} 个读数 (查询 {elapsed_ms:.1f} ms)")
+                        for i in range(max(0, len(result["timestamps"]) - 24), len(result["timestamps"])): # 只显示最后 24 个
+                            ts = time.strftime('%Y-%m-%d %H:%M', time.localtime(result["timestamps"][i]))
+                            print(f"  - {ts}: 平均 {result['avg'][i]:.2f}，最低 {result['min'][i]}，"
+                                  f"最高 {result['max'][i]}，{result['count'][i]} 个读数")
+
+            elif command == "stats":
+                stats = device_manager.get_stats()
+                admission_stats = stats["admission"]
+                print(f"准入控制: 占用 {admission_stats['in_use']}/{admission_stats['capacity']}，"
+                      f"限速拒绝 {admission_stats['rate_limited']} 次，跟踪客户端 {admission_stats['tracked_clients']} 个")
+                for lane, lane_stats in admission_stats["lanes"].items():
+                    print(f"  - {lane}: 排队 {lane_stats['queue_depth']}/{lane_stats['max_queue']}，"
+                          f"通过 {lane_stats['admitted']}，拒绝 {lane_stats['rejected']}，"
+                          f"最长等待 {lane_stats['max_wait_ms']} ms")
+                for prefix, gate_stats in stats.get("backend_admission", {}).items():
+                    lanes = gate_stats["lanes"].values()
+                    print(f"  远程控制器 {prefix}: 占用 {gate_stats['in_use']}/{gate_stats['capacity']}，"
+                          f"排队 {sum(lane['queue_depth'] for lane in lanes)}，通过 {sum(lane['admitted'] for lane in lanes)}，"
+                          f"拒绝 {sum(lane['rejected'] for lane in lanes)}")
+                print(f"状态缓存: 命中 {stats['cache']['hits']} 次，HAL 读取 {stats['cache']['hal_reads']} 次")
+                poller_stats = stats.get("poller")
+                if poller_stats:
+                    print(f"传感器轮询: {poller_stats['sensors']} 个传感器，每小时读取 {poller_stats['reads_per_hour']} 次 "
+                          f"(固定 {SENSOR_POLL_MIN_INTERVAL:g} 秒: {poller_stats['min_interval_reads_per_hour']} 次，"
+                          f"原 30 秒任务: {poller_stats['baseline_reads_per_hour']} 次)，当前间隔 {poller_stats['intervals']}")
+                for prefix, hal_stats in stats.get("hal", {}).items():
+                    if "address" not in hal_stats:
+                        continue # 本机 ActualHAL 没有连接统计
+                    print(f"远程控制器 {prefix} ({hal_stats['address']}): 连接 {hal_stats['connections']}，"
+                          f"请求 {hal_stats['requests']}，发送消息 {hal_stats['messages']} "
+                          f"(批量 {hal_stats['batched']}，合并 {hal_stats['coalesced']})，建立连接 {hal_stats['connects']} 次")
+
+            elif command == "profile":
+                if not args or args[0] not in ("start", "stop", "status") or len(args) > 3:
+                    print("用法: profile start [sample|cprofile|trace] [文件] | profile stop | profile status")
+                elif args[0] == "start":
+                    try:
+                        profiler.start(args[1] if len(args) > 1 else "sample", output_dir=PROFILE_DIR,
+                                       path=args[2] if len(args) > 2 else None)
+                    except (ValueError, OSError) as e:
+                        print(f"CLI Error: 无法开始分析: {e}")
+                elif args[0] == "stop":
+                    try:
+                        summary = profiler.stop()
+                    except (ValueError, OSError) as e:
+                        print(f"CLI Error: 无法停止分析: {e}")
+                    else:
+                        print(f"{summary['mode']} 分析 {summary['duration_seconds']} 秒，结果: {summary['output']}")
+                        if summary["mode"] == "sample":
+                            print(f"共 {summary['samples']} 次采样，{summary['threads']} 类线程；占用最多的函数:")
+                            for entry in summary["top"]:
+                                print(f"  {entry['percent']:5.1f}%  {entry['frame']}")
+                        elif summary["mode"] == "cprofile":
+                            print(f"合并了 {summary['threads']} 个线程的 cProfile 结果"
+                                  + (f" (未到达检查点: {', '.join(summary['missing_threads'])})" if summary["missing_threads"] else ""))
+                            print(summary.get("report", ""))
+                        else:
+                            print(f"共 {summary['requests']} 个请求，各阶段耗时 (毫秒, p50 / p99):")
+                            for command_name, result in summary["commands"].items():
+                                stages = "  ".join(f"{stage} {values['p50']:.3f}/{values['p99']:.3f}"
+                                                   for stage, values in result["stages_ms"].items())
+                                print(f"  {command_name} ({result['requests']}): {stages}")
+                else:
+                    print(f"分析状态: {profiler.status()}")
+
+            elif command == "rules":
+                if rules_engine is None:
+                    print("规则引擎未启用。")
+                else:
+                    rules = rules_engine.list_rules()
+                    print(f"自动化规则 ({len(rules)} 条):")
+                    for rule in rules:
+                        print(f"  - {rule['name']}: {rule['match']} {rule['conditions']} "
+                              f"(成立: {rule['matched']}, 已触发: {rule['fired']}, 触发次数: {rule['fire_count']})")
+
             elif command in ["exit", "quit"]:
                 print("CLI: 收到退出命令，正在通知主程序关闭...")
                 stop_event.set() # 设置停止事件
@@ -313,6 +679,11 @@ def run_cli(device_manager: DeviceManager, stop_event: threading.Event):
 
 # --- 主程序设置 ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="智能家居控制器")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="服务器工作进程数 (SO_REUSEPORT)，0 表示在主进程中以线程方式处理连接 (默认)")
+    cli_args = parser.parse_args()
+
     print("Main Controller: 启动...")
     HOST, PORT = "localhost", 9998 # 或者 "0.0.0.0" 监听所有接口
     current_time_local = time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime())
@@ -340,12 +711,32 @@ if __name__ == "__main__":
     server_thread = None
     cli_thread = None
     server = None # 初始化 server 变量
+    rules_engine = None
+    ipc_server = None
+    worker_pids = []
+    http_server = None
+    http_thread = None
 
     try:
+        # 0. 多进程模式: 在创建任何线程和打开设备之前 fork 工作进程
+        if cli_args.workers > 0:
+            if not hasattr(socket, "SO_REUSEPORT"):
+                print("Main Controller FATAL: 当前平台不支持 SO_REUSEPORT，无法使用 --workers。")
+                sys.exit(1)
+            ipc_authkey = os.urandom(16)
+            worker_pids = start_server_workers(cli_args.workers, HOST, PORT, IPC_SOCKET_PATH,
+                                               ipc_authkey, SHM_STATE_PATH)
+            print("-" * 30)
+
         # 1. 初始化 ActualHAL 和 DeviceManager
         print("Main Controller: 初始化 ActualHAL...")
         try:
             hal = ActualHAL(DEVICE_CONFIG)
+            if REMOTE_CONTROLLERS:
+                # 前端控制器: 本机设备 ID 不变，其他楼层的设备以 "前缀:设备ID" 访问
+                remote_hals = {prefix: RemoteHAL(host, port, pool_size=REMOTE_POOL_SIZE)
+                               for prefix, (host, port) in REMOTE_CONTROLLERS.items()}
+                hal = CompositeHAL({"": hal, **remote_hals})
         except DeviceConfigurationError as e:
              print(f"Main Controller FATAL: HAL 初始化失败: {e}")
              print("请确保 C 驱动 'smart_device_driver.ko' 已加载 (sudo insmod) 并且设备文件 /dev/smart_* 存在且权限正确 (e.g., sudo chmod 666 /dev/smart_*)")
@@ -356,7 +747,23 @@ if __name__ == "__main__":
 
         print("Main Controller: 初始化 DeviceManager...")
         try:
-             device_manager = DeviceManager(hal)
+             journal = StateJournal(JOURNAL_DIR, durability=JOURNAL_DURABILITY,
+                                    fsync_interval=JOURNAL_FSYNC_INTERVAL,
+                                    snapshot_interval=JOURNAL_SNAPSHOT_INTERVAL)
+             state_table = None
+             if SHM_STATE_PATH:
+                 try:
+                     state_table = SharedStateTable(SHM_STATE_PATH, capacity=SHM_STATE_CAPACITY)
+                 except (StateTableError, OSError) as e:
+                     print(f"Main Controller Warning: 无法创建共享内存状态表，本机读者将不可用: {e}")
+             access_gate = PriorityGate(capacity=1, max_queue=ADMISSION_MAX_QUEUE,
+                                        client_rate=CLIENT_RATE_LIMIT, client_burst=CLIENT_BURST)
+             # 远程控制器的请求经连接池流水线转发，每个远程控制器一个准入控制，允许多个操作同时等待远程响应
+             backend_gates = {prefix: PriorityGate(capacity=REMOTE_HAL_CONCURRENCY, max_queue=ADMISSION_MAX_QUEUE)
+                              for prefix in REMOTE_CONTROLLERS}
+             rollups = SensorRollupStore(ROLLUP_DIR) if ROLLUP_DIR else None
+             device_manager = DeviceManager(hal, journal=journal, state_table=state_table, access_gate=access_gate,
+                                            rollups=rollups, backend_gates=backend_gates)
         except ValueError as e:
              print(f"Main Controller FATAL: DeviceManager 初始化失败: {e}")
              sys.exit(1)
@@ -373,34 +780,61 @@ if __name__ == "__main__":
         # 定时开关卧室灯
         schedule.every().day.at("07:00").do(functools.partial(set_device_task, device_manager, "light_bedroom", "on"))
         schedule.every().day.at("09:00").do(functools.partial(set_device_task, device_manager, "light_bedroom", "off"))
-        # 每 30 秒读取一次温度传感器
+        # 每 30 秒记录一次温度传感器读数 (传感器由后台自适应轮询读取，这里通常直接命中缓存)
         schedule.every(30).seconds.do(functools.partial(read_sensor_task, device_manager, "sensor_temp_main"))
         # 每 15 秒切换一次厨房插座状态 (用于测试)
         # schedule.every(15).seconds.do(functools.partial(toggle_light_task, device_manager, "socket_kitchen")) # 注意toggle函数需要实现
         print("  - 任务配置完成。")
         print("-" * 30)
 
+        # 2.1 启动后台自适应传感器轮询
+        device_manager.start_sensor_poller(min_interval=SENSOR_POLL_MIN_INTERVAL,
+                                           max_interval=SENSOR_POLL_MAX_INTERVAL,
+                                           change_threshold=SENSOR_POLL_CHANGE_THRESHOLD)
+
+        # 2.2 启动规则引擎 (订阅 DeviceManager 的状态变化)
+        print("Main Controller: 启动规则引擎...")
+        rules_engine = RulesEngine(device_manager)
+        rules_engine.load_rules(RULES_CONFIG)
+        rules_engine.start()
+        print("-" * 30)
+
         # 3. 启动调度器线程
         print("Main Controller: 启动调度器线程...")
         scheduler_thread = threading.Thread(target=run_scheduler, args=(stop_event,), daemon=True)
         scheduler_thread.start()
         print("-" * 30)
 
-        # 4. 启动网络服务器线程
-        print("Main Controller: 启动网络服务器线程...")
-        # 创建自定义的 TCP Handler，将 device_manager 传递给它
-        handler_with_manager = functools.partial(SmartHomeControllerTCPHandler)
-        # 创建服务器实例，将 device_manager 关联到服务器
-        server = ThreadingTCPServerWithManager((HOST, PORT), handler_with_manager, device_manager)
-
-        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
-        server_thread.start()
-        print(f"Network Server: 服务器已在 {HOST}:{PORT} 启动并监听...")
+        # 4. 启动网络服务器线程 (多进程模式下改为启动 IPC 服务，由工作进程监听端口)
+        if worker_pids:
+            print("Main Controller: 启动 HAL 进程的 IPC 服务...")
+            ipc_server = DeviceManagerIPCServer(device_manager, IPC_SOCKET_PATH, ipc_authkey)
+            ipc_server.start()
+            print(f"Network Server: {len(worker_pids)} 个工作进程在 {HOST}:{PORT} 上监听 (SO_REUSEPORT)...")
+        else:
+            print("Main Controller: 启动网络服务器线程...")
+            # 创建自定义的 TCP Handler，将 device_manager 传递给它
+            handler_with_manager = functools.partial(SmartHomeControllerTCPHandler)
+            # 创建服务器实例，将 device_manager 关联到服务器
+            server = ThreadingTCPServerWithManager((HOST, PORT), handler_with_manager, device_manager)
+
+            server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+            server_thread.start()
+            print(f"Network Server: 服务器已在 {HOST}:{PORT} 启动并监听...")
         print("-" * 30)
 
+        # 4.1 启动 HTTP 网关线程 (在主进程中运行，直接使用同一个 DeviceManager)
+        if HTTP_PORT:
+            print("Main Controller: 启动 HTTP 网关线程...")
+            http_server = SmartHomeHTTPServer((HOST, HTTP_PORT), device_manager)
+            http_thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+            http_thread.start()
+            print(f"HTTP Gateway: 已在 http://{HOST}:{HTTP_PORT}/ 启动并监听...")
+            print("-" * 30)
+
         # 5. 启动 CLI 线程 (非守护线程)
         print("Main Controller: 启动 CLI 线程...")
-        cli_thread = threading.Thread(target=run_cli, args=(device_manager, stop_event))
+        cli_thread = threading.Thread(target=run_cli, args=(device_manager, stop_event, rules_engine))
         cli_thread.start()
         print("-" * 30)
 
@@ -441,6 +875,17 @@ if __name__ == "__main__":
                  server_thread.join(timeout=2)
                  if server_thread.is_alive():
                       print("Main Controller Warning: 网络服务器线程未能及时停止。")
+        if http_server:
+            print("Main Controller: 正在关闭 HTTP 网关...")
+            http_server.shutdown()
+            http_server.server_close()
+            if http_thread and http_thread.is_alive():
+                http_thread.join(timeout=2)
+        if worker_pids:
+            print("Main Controller: 正在停止服务器工作进程...")
+            stop_server_workers(worker_pids)
+        if ipc_server:
+            ipc_server.stop()
 
 
         # 3. 等待 CLI 线程结束
@@ -452,5 +897,16 @@ if __name__ == "__main__":
             if cli_thread.is_alive():
                  print("Main Controller Warning: CLI 线程未能及时停止 (可能卡在input?)。")
 
+        # 4. 停止规则引擎
+        if rules_engine:
+            rules_engine.stop()
+
+        # 5. 关闭 DeviceManager (刷盘并关闭状态日志、共享状态表)
+        if device_manager:
+            print("Main Controller: 正在关闭 DeviceManager (刷写状态日志)...")
+            device_manager.close()
+        if hal is not None and hasattr(hal, "close"): # 关闭到远程控制器的连接
+            hal.close()
+
         print("Main Controller: 服务已停止。程序结束。")
         sys.exit(0) # 确保程序退出
\ No newline at end of file
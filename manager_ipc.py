@@ -0,0 +1,234 @@
+# manager_ipc.py
+import os
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+
+from hal_actual import DeviceConfigurationError
+from admission import DeviceBusyError
+from profiler import profiler
+from shm_state_reader import SharedStateReader, StateTableError
+
+# 允许通过 IPC 调用的 DeviceManager 方法 (白名单)
+EXPORTED_METHODS = (
+    "get_device_state",
+    "set_device_state",
+    "get_all_devices_status",
+    "list_all_devices",
+    "get_cached_state",
+    "get_device_version",
+    "get_sensor_history",
+    "get_sensor_rollup",
+    "get_stats",
+)
+
+# 可以跨进程原样重建的异常类型，其他异常在代理端统一转换为 RuntimeError
+REMOTE_EXCEPTIONS = {
+    "DeviceConfigurationError": DeviceConfigurationError,
+    "DeviceBusyError": DeviceBusyError,
+    "ValueError": ValueError,
+}
+
+class DeviceManagerIPCServer:
+    """
+    在拥有 HAL 的进程中运行，通过 Unix 域套接字把 DeviceManager 暴露给服务器工作进程。
+    所有设备 I/O 仍然由本进程的同一个 DeviceManager 完成，因此对同一设备的写入保持串行。
+    消息格式 (multiprocessing.connection，pickle 编码):
+      请求: (method_name, args, kwargs)
+      响应: ("ok", result) 或 ("error", exception_type_name, message)
+    """
+    def __init__(self, device_manager, address, authkey):
+        self.device_manager = device_manager
+        self.address = address
+        if os.path.exists(address):
+            os.remove(address) # 清理上次异常退出留下的套接字文件
+        self._listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        self._authkey = authkey
+        self._stop_event = threading.Event()
+        self._accept_thread = None
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        print(f"ManagerIPC: IPC 服务已在 {address} 监听。")
+
+    def start(self):
+        self._accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._accept_thread.start()
+
+    def _accept_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                break # 监听套接字已关闭
+            except Exception as e:
+                print(f"ManagerIPC Warning: 接受 IPC 连接失败 (认证错误?): {e}")
+                continue
+            if self._stop_event.is_set():
+                conn.close()
+                break
+            with self._connections_lock:
+                self._connections.add(conn)
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _serve_connection(self, conn):
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    method_name, args, kwargs = conn.recv()
+                except (EOFError, OSError, TypeError):
+                    break # 工作进程断开，或 stop() 在另一个线程关闭了连接 (recv 得到 TypeError)
+                profiler.checkpoint()
+                if method_name not in EXPORTED_METHODS:
+                    conn.send(("error", "ValueError", f"不允许通过 IPC 调用方法 '{method_name}'"))
+                    continue
+                try:
+                    result = getattr(self.device_manager, method_name)(*args, **kwargs)
+                    conn.send(("ok", result))
+                except Exception as e:
+                    conn.send(("error", type(e).__name__, str(e)))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            profiler.release()
+            with self._connections_lock:
+                self._connections.discard(conn)
+            conn.close()
+
+    def stop(self):
+        self._stop_event.set()
+        # accept() 不会因为 close 而立即返回，先连接一次把它唤醒
+        try:
+            Client(self.address, family='AF_UNIX', authkey=self._authkey).close()
+        except Exception:
+            pass
+        self._listener.close()
+        if self._accept_thread:
+            self._accept_thread.join(timeout=2)
+        with self._connections_lock:
+            for conn in list(self._connections):
+                conn.close()
+        print("ManagerIPC: IPC 服务已停止。")
+
+class DeviceManagerProxy:
+    """
+    工作进程中使用的 DeviceManager 代理，接口与 DeviceManager 相同。
+    - 设备操作通过 IPC 转发给 HAL 进程。TCP 服务器每个客户端连接一个线程，因此 IPC 连接不按线程建立，
+      而是放在最多 pool_size 条的连接池中，每次调用借出、用完归还 (同时进行的调用超过 pool_size 时等待)
+    - get_cached_state / get_device_version 优先直接读共享内存状态表，不经过 IPC
+    """
+    CONNECT_TIMEOUT = 10.0
+    POOL_SIZE = 8 # 每个工作进程到 HAL 进程的最大 IPC 连接数
+    DEVICE_LIST_TTL = 30.0 # 设备列表的缓存时间 (秒)，HAL 进程会发现新上线的设备
+
+    def __init__(self, address, authkey, state_table_path=None, pool_size=POOL_SIZE):
+        self.address = address
+        self._authkey = authkey
+        self._pool_slots = threading.BoundedSemaphore(pool_size)
+        self._idle = [] # 空闲的 IPC 连接
+        self._pool_lock = threading.Lock()
+        self._state_reader = None
+        self._state_table_path = state_table_path
+        self._known_devices = None # 设备列表缓存 DEVICE_LIST_TTL 秒
+        self._known_devices_fetched = 0.0
+
+    def _get_state_reader(self):
+        if self._state_reader is None and self._state_table_path:
+            try:
+                self._state_reader = SharedStateReader(self._state_table_path)
+            except StateTableError as e:
+                print(f"ManagerIPC Warning: 无法打开共享状态表，缓存读取将走 IPC: {e}")
+                self._state_table_path = None
+        return self._state_reader
+
+    def _connect(self):
+        # HAL 进程可能还在启动，短暂重试
+        deadline = time.time() + self.CONNECT_TIMEOUT
+        while True:
+            try:
+                return Client(self.address, family='AF_UNIX', authkey=self._authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() >= deadline:
+                    raise
+                time.sleep(0.1)
+
+    def _checkout(self):
+        """从连接池借出一条连接，没有空闲连接时新建 (总数不超过 pool_size)"""
+        self._pool_slots.acquire()
+        with self._pool_lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except BaseException:
+            self._pool_slots.release()
+            raise
+
+    def _checkin(self, conn):
+        """归还连接；conn 为 None 表示连接已损坏并关闭"""
+        if conn is not None:
+            with self._pool_lock:
+                self._idle.append(conn)
+        self._pool_slots.release()
+
+    def _call(self, method_name, *args, **kwargs):
+        conn = self._checkout()
+        try:
+            conn.send((method_name, args, kwargs))
+            reply = conn.recv()
+        except BaseException as e:
+            # 请求/响应没有完整收发，丢弃连接，下次调用时重连
+            conn.close()
+            conn = None
+            if isinstance(e, (EOFError, OSError)):
+                # 连接断开 (例如 HAL 进程重启)：其余空闲连接连的是同一个已退出的进程，一并丢弃
+                with self._pool_lock:
+                    stale, self._idle = self._idle, []
+                for stale_conn in stale:
+                    stale_conn.close()
+            raise
+        finally:
+            self._checkin(conn)
+        if reply[0] == "ok":
+            return reply[1]
+        _, exc_name, message = reply
+        raise REMOTE_EXCEPTIONS.get(exc_name, RuntimeError)(message)
+
+    def get_device_state(self, device_id, **kwargs):
+        return self._call("get_device_state", device_id, **kwargs)
+
+    def set_device_state(self, device_id, state, **kwargs):
+        return self._call("set_device_state", device_id, state, **kwargs)
+
+    def get_all_devices_status(self, **kwargs):
+        return self._call("get_all_devices_status", **kwargs)
+
+    def list_all_devices(self):
+        if self._known_devices is None or time.monotonic() - self._known_devices_fetched > self.DEVICE_LIST_TTL:
+            self._known_devices = self._call("list_all_devices")
+            self._known_devices_fetched = time.monotonic()
+        return self._known_devices.copy()
+
+    def get_sensor_history(self, device_id, since=None):
+        return self._call("get_sensor_history", device_id, since)
+
+    def get_sensor_rollup(self, device_id, start=None, end=None, resolution=3600):
+        return self._call("get_sensor_rollup", device_id, start, end, resolution)
+
+    def get_stats(self):
+        return self._call("get_stats")
+
+    def get_cached_state(self, device_id):
+        reader = self._get_state_reader()
+        if reader is None:
+            return self._call("get_cached_state", device_id)
+        info = reader.read(device_id)
+        if info is None or info["state"] is None:
+            return None
+        return {"state": info["state"], "last_updated": info["last_updated"]}
+
+    def get_device_version(self, device_id):
+        reader = self._get_state_reader()
+        if reader is None:
+            return self._call("get_device_version", device_id)
+        info = reader.read(device_id)
+        return info["version"] if info else 0
@@ -0,0 +1,390 @@
+# profiler.py
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+PROFILE_MODES = ("sample", "cprofile", "trace")
+TRACE_STAGES = ("framing", "json_parse", "gate_wait", "hal_io", "serialization")
+# Python 3.12 起 cProfile 基于 sys.monitoring，一个 Profile 覆盖进程内所有线程，且同一时间只能开启一个
+PROCESS_WIDE_CPROFILE = sys.version_info >= (3, 12)
+
+def _thread_label(name):
+    """线程名去掉编号 (Thread-12 (process_request_thread) -> Thread (process_request_thread))，同类线程的样本合并"""
+    return re.sub(r"-\d+", "", name).replace(";", ",")
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """
+    低开销的采样分析器：后台线程每 interval 秒通过 sys._current_frames() 抓取所有线程的调用栈，
+    按 "线程;外层函数;...;内层函数" 计数，输出 collapsed-stack 格式 (可直接交给 flamegraph.pl / speedscope)。
+    被分析的线程不需要任何改动，开销只取决于采样频率。
+    """
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self.sample_count = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(_thread_label(names.get(ident, f"thread-{ident}")))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def summary(self, top=10):
+        """按最内层函数 (正在执行的函数) 统计样本占比最高的 top 个"""
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return {"samples": self.sample_count,
+                "threads": len({stack.split(";", 1)[0] for stack in self.samples}),
+                "top": [{"frame": frame, "percent": round(count * 100 / total, 1)}
+                        for frame, count in leaves.most_common(top)]}
+
+class RequestTracer:
+    """
+    按请求记录各阶段耗时 (framing、JSON 解析、准入等待、HAL I/O、序列化)。
+    请求处理线程调用 ProfilerController.trace_begin/trace_end，中间各层用 trace_stage 记录阶段耗时。
+    """
+    def __init__(self, max_traces=100000):
+        self.traces = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def add(self, trace):
+        with self._lock:
+            self.traces.append(trace)
+
+    def write(self, path):
+        with self._lock:
+            traces = list(self.traces)
+        with open(path, "w", encoding="utf-8") as f:
+            for trace in traces:
+                f.write(json.dumps(trace) + "\n")
+
+    def summary(self):
+        """每个命令各阶段的平均/p50/p99/最大耗时 (毫秒)"""
+        with self._lock:
+            traces = list(self.traces)
+        by_command = {}
+        for trace in traces:
+            by_command.setdefault(trace["command"], []).append(trace)
+        result = {}
+        for command, command_traces in by_command.items():
+            stages = {}
+            for stage in TRACE_STAGES + ("other", "total"):
+                values = sorted(trace["stages_ms"].get(stage, 0.0) for trace in command_traces)
+                n = len(values)
+                stages[stage] = {"mean": round(sum(values) / n, 3), "p50": values[n // 2],
+                                 "p99": values[min(n - 1, int(n * 0.99))], "max": values[-1]}
+            result[command] = {"requests": len(command_traces), "stages_ms": stages}
+        return {"requests": len(traces), "commands": result}
+
+class ProfilerController:
+    """
+    运行时按需开启/关闭分析 (CLI / TCP 的 profile 命令)，同一时间只允许一个分析会话：
+    - sample:   SamplingProfiler，覆盖所有线程，输出 collapsed-stack 文本 (.folded)
+    - cprofile: 输出 pstats 文件 (.prof)。Python 3.12 起开启一个覆盖所有线程的 cProfile.Profile；
+                更早的版本中 cProfile 只能分析开启它的线程，因此各长期运行的线程在循环中调用 checkpoint()，
+                由线程自己开启/关闭自己的 Profile，停止时合并
+    - trace:    RequestTracer，记录每个请求各阶段的耗时，输出 JSON lines (.jsonl)
+    未开启分析时 checkpoint / trace_* 只做一次属性检查；checkpoint 从不抛出异常。
+    """
+    FILE_SUFFIX = {"sample": "folded", "cprofile": "prof", "trace": "jsonl"}
+    CHECKPOINT_WAIT = 2.0 # 停止 cprofile 会话时等待各线程到达 checkpoint 的时间 (秒)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._mode = None
+        self._session = 0
+        self._started_at = None
+        self._output = None
+        self._sampler = None
+        self._tracer = None
+        self._process_profile = None # Python 3.12+ 的 cprofile 模式: 覆盖所有线程的唯一 Profile
+        self._thread_profiling = False # 按线程的 cprofile 会话运行中 (checkpoint 需要开启 Profile)
+        self._profiles = {}  # cprofile 模式: 线程 ident -> (线程名, cProfile.Profile)，正在分析中
+        self._finished = []  # cprofile 模式: 已由所属线程关闭的 (线程名, cProfile.Profile)
+        self._open_profiles = 0 # 仍处于开启状态的线程 Profile 数 (包括已结束会话遗留的)
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def start(self, mode="sample", output_dir=".", path=None, interval=0.005):
+        """
+        开始一个分析会话。
+        :param mode: sample / cprofile / trace
+        :param output_dir: 结果文件目录 (未指定 path 时按模式和时间生成文件名)
+        :param path: 结果文件路径 (可选)
+        :param interval: sample 模式的采样间隔 (秒)
+        :return: 结果文件路径
+        :raises ValueError: 模式无效、已有分析会话在运行或 cProfile 无法开启 (例如调试器/覆盖率工具已占用)
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"未知的分析模式 '{mode}'，可选: {', '.join(PROFILE_MODES)}")
+        if not 0 < interval <= 1:
+            raise ValueError("采样间隔需要在 (0, 1] 秒之间")
+        with self._lock:
+            if self._mode is not None:
+                raise ValueError(f"已有 {self._mode} 分析会话在运行，请先 profile stop")
+            if path is None:
+                os.makedirs(output_dir, exist_ok=True)
+                path = os.path.join(output_dir, f"profile-{mode}-{time.strftime('%Y%m%d-%H%M%S')}.{self.FILE_SUFFIX[mode]}")
+            self._session += 1
+            self._started_at = time.monotonic()
+            self._output = path
+            if mode == "sample":
+                self._sampler = SamplingProfiler(interval)
+                self._sampler.start()
+            elif mode == "trace":
+                self._tracer = RequestTracer()
+            elif PROCESS_WIDE_CPROFILE:
+                profile = cProfile.Profile()
+                profile.enable() # 失败时抛出 ValueError，会话不会开始
+                self._process_profile = profile
+            else:
+                self._profiles = {}
+                self._finished = []
+                self._thread_profiling = True
+            self._mode = mode
+        print(f"Profiler: 已开始 {mode} 分析，结果将写入 {path}")
+        return path
+
+    def stop(self):
+        """停止当前分析会话，写出结果文件，返回摘要字典"""
+        with self._lock:
+            mode = self._mode
+            if mode is None:
+                raise ValueError("没有正在运行的分析会话")
+            self._mode = None
+            self._thread_profiling = False
+            path = self._output
+            summary = {"mode": mode, "output": path,
+                       "duration_seconds": round(time.monotonic() - self._started_at, 1)}
+            sampler, self._sampler = self._sampler, None
+            tracer, self._tracer = self._tracer, None
+            process_profile, self._process_profile = self._process_profile, None
+        if mode == "sample":
+            sampler.stop()
+            sampler.write(path)
+            summary.update(sampler.summary())
+        elif mode == "trace":
+            tracer.write(path)
+            summary.update(tracer.summary())
+        elif process_profile is not None:
+            process_profile.disable()
+            summary.update(self._write_cprofile(path, [(None, process_profile)], []))
+        else:
+            summary.update(self._stop_cprofile(path))
+        print(f"Profiler: {mode} 分析已停止，结果已写入 {path}")
+        return summary
+
+    def _stop_cprofile(self, path):
+        self.checkpoint() # 调用 stop 的线程立即关闭自己的 Profile
+        deadline = time.monotonic() + self.CHECKPOINT_WAIT
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._profiles:
+                    break
+            time.sleep(0.05)
+        with self._lock:
+            finished, self._finished = self._finished, []
+            # 没有及时到达 checkpoint 的线程 (例如阻塞在 input() 上的 CLI) 不计入结果，
+            # 它们会在下一次 checkpoint 时自行关闭 Profile
+            missing = sorted({name for name, _ in self._profiles.values()})
+            self._profiles = {}
+        return self._write_cprofile(path, finished, missing)
+
+    def _write_cprofile(self, path, finished, missing):
+        """合并 (线程名, Profile) 列表写出 pstats 文件；线程名为 None 表示覆盖所有线程的 Profile"""
+        if not finished:
+            open(path, "wb").close()
+            return {"threads": 0, "missing_threads": missing, "top": []}
+        stats = pstats.Stats(finished[0][1])
+        for _, profile in finished[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        report = io.StringIO()
+        stats.stream = report
+        stats.sort_stats("cumulative").print_stats(15)
+        result = {"missing_threads": missing, "report": report.getvalue()}
+        if finished[0][0] is None:
+            result["threads"] = "all"
+        else:
+            result["threads"] = len(finished)
+            result["thread_names"] = sorted({_thread_label(name) for name, _ in finished})
+        return result
+
+    def status(self):
+        with self._lock:
+            if self._mode is None:
+                return {"mode": None}
+            return {"mode": self._mode, "output": self._output,
+                    "elapsed_seconds": round(time.monotonic() - self._started_at, 1)}
+
+    # --- cprofile 模式的线程检查点 ---
+    def checkpoint(self):
+        """
+        长期运行的线程在每次循环时调用：按线程的 cprofile 会话运行中则为本线程开启 Profile，会话结束则关闭并提交。
+        分析出错只打印警告，不会让调用线程退出。
+        """
+        if not self._thread_profiling:
+            if self._open_profiles: # 快速路径: 没有任何线程开着 Profile 时不访问线程局部变量
+                self.release()
+            return
+        try:
+            self._open_thread_profile()
+        except Exception as e:
+            self._local.failed_session = self._session # 本会话内不再重试，避免每次循环都打印警告
+            print(f"Profiler: 线程 {threading.current_thread().name} 开启 cProfile 失败，本次会话不分析该线程: {e}")
+
+    def _open_thread_profile(self):
+        current = getattr(self._local, "profile", None)
+        if current is not None and current[0] == self._session:
+            return
+        if getattr(self._local, "failed_session", None) == self._session:
+            return
+        if current is not None:
+            self.release() # 上一个会话遗留的 Profile
+        profile = cProfile.Profile()
+        ident = threading.get_ident()
+        with self._lock:
+            if not self._thread_profiling:
+                return
+            session = self._session
+            self._profiles[ident] = (threading.current_thread().name, profile)
+        try:
+            profile.enable()
+        except Exception:
+            with self._lock:
+                self._profiles.pop(ident, None)
+            raise
+        with self._lock:
+            self._open_profiles += 1
+        self._local.profile = (session, profile)
+
+    def release(self):
+        """本线程停止分析 (线程退出前调用，例如请求处理线程结束时)。不会抛出异常。"""
+        current = getattr(self._local, "profile", None)
+        if current is None:
+            return
+        session, profile = current
+        self._local.profile = None
+        try:
+            profile.disable()
+        except Exception as e:
+            print(f"Profiler: 线程 {threading.current_thread().name} 关闭 cProfile 失败: {e}")
+        with self._lock:
+            self._open_profiles -= 1
+            entry = self._profiles.pop(threading.get_ident(), None)
+            if entry is not None and session == self._session:
+                self._finished.append(entry)
+
+    # --- trace 模式 ---
+    def trace_begin(self, **stages):
+        """开始记录当前线程的一个请求；未开启 trace 时返回 None。stages 为已经发生的阶段耗时 (秒)"""
+        if self._tracer is None:
+            return None
+        trace = {"start": time.perf_counter(), "stages": dict(stages)}
+        self._local.trace = trace
+        return trace
+
+    def trace_stage(self, stage, seconds):
+        """把一段耗时记入当前线程正在记录的请求 (没有则忽略)"""
+        trace = getattr(self._local, "trace", None)
+        if trace is not None:
+            trace["stages"][stage] = trace["stages"].get(stage, 0.0) + seconds
+
+    def trace_end(self, trace, command):
+        if trace is None:
+            return
+        self._local.trace = None
+        tracer = self._tracer
+        if tracer is None:
+            return
+        stages = trace["stages"]
+        total = time.perf_counter() - trace["start"] + stages.get("framing", 0.0)
+        stages_ms = {stage: round(seconds * 1000, 3) for stage, seconds in stages.items()}
+        stages_ms["other"] = round(max(0.0, total - sum(stages.values())) * 1000, 3)
+        stages_ms["total"] = round(total * 1000, 3)
+        tracer.add({"time": time.time(), "command": command, "stages_ms": stages_ms})
+
+# 进程内唯一的分析控制器，各线程的检查点和请求跟踪都通过它
+profiler = ProfilerController()
+
+
+# --- 测试代码: 分别用三种模式分析几个工作线程 ---
+if __name__ == "__main__":
+    import tempfile
+
+    stop = threading.Event()
+
+    def busy_loop(name):
+        while not stop.is_set():
+            profiler.checkpoint()
+            trace = profiler.trace_begin(framing=0.0001)
+            io_start = time.perf_counter()
+            sum(i * i for i in range(20000)) if name == "cpu" else time.sleep(0.01)
+            profiler.trace_stage("hal_io", time.perf_counter() - io_start)
+            profiler.trace_end(trace, name)
+        profiler.release()
+
+    workers = [threading.Thread(target=busy_loop, args=(name,), name=name) for name in ("cpu", "io")]
+    for worker in workers:
+        worker.start()
+    with tempfile.TemporaryDirectory() as output_dir:
+        for mode in PROFILE_MODES:
+            profiler.start(mode, output_dir=output_dir)
+            time.sleep(1.0)
+            summary = profiler.stop()
+            summary.pop("report", None)
+            if mode == "trace":
+                summary["commands"] = {command: {stage: values["p50"] for stage, values in result["stages_ms"].items()}
+                                       for command, result in summary["commands"].items()} # 只显示各阶段 p50
+            print(f"{mode}: {json.dumps(summary, ensure_ascii=False)}")
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+        # 未开启分析时检查点的开销
+        n = 1000000
+        start = time.perf_counter()
+        for _ in range(n):
+            profiler.checkpoint()
+        print(f"未开启分析时 checkpoint() 开销: {(time.perf_counter() - start) / n * 1e9:.0f} ns/次")
@@ -0,0 +1,352 @@
+# rules_engine.py
+import heapq
+import queue
+import threading
+import time
+
+from admission import PRIORITY_SCHEDULED
+from profiler import profiler
+
+class RuleConfigurationError(ValueError):
+    """规则定义无效 (缺少字段、未知运算符等)"""
+    pass
+
+class Condition:
+    """
+    单个条件，例如 sensor_temp_main > 30。
+    支持回差 (hysteresis)：条件一旦成立，需要越过 阈值 ± hysteresis 才会恢复为不成立，
+    避免传感器在阈值附近抖动时反复触发。
+    """
+    OPERATORS = (">", ">=", "<", "<=", "==", "!=")
+
+    def __init__(self, device_id, op, value, hysteresis=0.0):
+        if op not in self.OPERATORS:
+            raise RuleConfigurationError(f"未知运算符 '{op}'，可选: {self.OPERATORS}")
+        if hysteresis < 0:
+            raise RuleConfigurationError("hysteresis 不能为负数")
+        self.device_id = device_id
+        self.op = op
+        self.value = value
+        self.hysteresis = hysteresis
+
+    def evaluate(self, current, was_true):
+        """
+        根据当前值计算条件是否成立。
+        :param current: 设备当前状态值，None 表示尚未观测到
+        :param was_true: 上一次的结果 (用于回差)
+        """
+        if current is None:
+            return False
+        op, threshold = self.op, self.value
+        try:
+            if op in (">", ">="):
+                if was_true:
+                    threshold -= self.hysteresis
+                return current > threshold if op == ">" else current >= threshold
+            if op in ("<", "<="):
+                if was_true:
+                    threshold += self.hysteresis
+                return current < threshold if op == "<" else current <= threshold
+        except TypeError:
+            return False # 例如把字符串状态与数字比较
+        if op == "==":
+            return current == threshold
+        return current != threshold
+
+    def __repr__(self):
+        return f"{self.device_id} {self.op} {self.value!r}"
+
+class Rule:
+    """
+    一条自动化规则：当条件 (all / any) 成立并持续 debounce 秒后执行 then 动作；
+    条件恢复为不成立时执行可选的 otherwise 动作。
+    """
+    def __init__(self, name, conditions, actions, match="all", debounce=0.0, otherwise=None):
+        if not conditions:
+            raise RuleConfigurationError(f"规则 '{name}' 至少需要一个条件")
+        if match not in ("all", "any"):
+            raise RuleConfigurationError(f"规则 '{name}' 的 match 必须是 'all' 或 'any'")
+        self.name = name
+        self.conditions = conditions
+        self.actions = actions
+        self.otherwise = otherwise or []
+        self.match = match
+        self.debounce = debounce
+        # 运行时状态 (由 RulesEngine 在其锁内维护)
+        self.condition_results = [False] * len(conditions)
+        self.matched = False    # 条件当前是否成立
+        self.fired = False      # then 动作是否已执行 (边沿触发，只执行一次)
+        self.pending_token = 0  # 防抖定时器的版本号，条件变化时递增以取消旧定时器
+        self.fire_count = 0
+
+    @classmethod
+    def from_dict(cls, config):
+        """从声明式配置 (见 main_controller.RULES_CONFIG) 创建规则"""
+        try:
+            name = config["name"]
+            conditions = [Condition(c["device_id"], c["op"], c["value"], c.get("hysteresis", 0.0))
+                          for c in config["when"]]
+            actions = [(a["device_id"], a["state"]) for a in config["then"]]
+            otherwise = [(a["device_id"], a["state"]) for a in config.get("otherwise", [])]
+        except KeyError as e:
+            raise RuleConfigurationError(f"规则定义缺少字段 {e}: {config}")
+        return cls(name, conditions, actions, match=config.get("match", "all"),
+                   debounce=config.get("debounce", 0.0), otherwise=otherwise)
+
+    def device_ids(self):
+        """该规则依赖的设备 ID 集合"""
+        return {condition.device_id for condition in self.conditions}
+
+class RulesEngine:
+    """
+    事件驱动的规则引擎。
+    规则按其依赖的设备 ID 建立索引，每次状态变化只重新计算受影响的规则，
+    并且只重新计算该设备相关的条件，单次事件的开销与规则总数无关。
+    动作和防抖定时器在独立的工作线程中执行，不阻塞产生事件的线程。
+    """
+    def __init__(self, device_manager):
+        self.device_manager = device_manager
+        self._rules = {}        # name -> Rule
+        self._index = {}        # device_id -> [(rule, condition_index), ...]
+        self._values = {}       # device_id -> 最近的状态值
+        self._lock = threading.Lock()
+
+        self._actions = queue.Queue()   # 待执行的 (rule_name, device_id, state)
+        self._timers = []               # 防抖定时器堆 [(deadline, seq, rule_name, token)]
+        self._timer_seq = 0
+        self._timer_cond = threading.Condition(self._lock)
+        self._stop_event = threading.Event()
+        self._threads = []
+
+        self._events_processed = 0
+        self._evaluations = 0
+        self._actions_executed = 0
+
+    # --- 规则管理 ---
+    def add_rule(self, rule):
+        """添加规则 (Rule 实例或字典配置)"""
+        if isinstance(rule, dict):
+            rule = Rule.from_dict(rule)
+        with self._lock:
+            if rule.name in self._rules:
+                raise RuleConfigurationError(f"规则 '{rule.name}' 已存在")
+            self._rules[rule.name] = rule
+            for i, condition in enumerate(rule.conditions):
+                self._index.setdefault(condition.device_id, []).append((rule, i))
+            # 用已知的最新值初始化条件结果
+            for i, condition in enumerate(rule.conditions):
+                rule.condition_results[i] = condition.evaluate(self._values.get(condition.device_id), False)
+            self._update_rule(rule, time.time())
+        return rule
+
+    def load_rules(self, configs):
+        """批量加载规则配置，返回成功加载的数量"""
+        loaded = 0
+        for config in configs:
+            try:
+                self.add_rule(config)
+                loaded += 1
+            except RuleConfigurationError as e:
+                print(f"RulesEngine Error: 加载规则失败: {e}")
+        print(f"RulesEngine: 已加载 {loaded} 条规则，索引了 {len(self._index)} 个设备。")
+        return loaded
+
+    def remove_rule(self, name):
+        """删除规则，返回是否存在"""
+        with self._lock:
+            rule = self._rules.pop(name, None)
+            if rule is None:
+                return False
+            rule.pending_token += 1 # 取消未到期的防抖定时器
+            for device_id in rule.device_ids():
+                entries = [entry for entry in self._index.get(device_id, []) if entry[0] is not rule]
+                if entries:
+                    self._index[device_id] = entries
+                else:
+                    self._index.pop(device_id, None)
+            return True
+
+    def list_rules(self):
+        """返回规则及其运行时状态的摘要列表"""
+        with self._lock:
+            return [{"name": rule.name,
+                     "conditions": [repr(c) for c in rule.conditions],
+                     "match": rule.match,
+                     "matched": rule.matched,
+                     "fired": rule.fired,
+                     "fire_count": rule.fire_count}
+                    for rule in self._rules.values()]
+
+    # --- 事件处理 ---
+    def on_state_change(self, device_id, state_info, previous=None):
+        """
+        DeviceManager 状态监听回调。只计算依赖 device_id 的规则中与之相关的条件。
+        """
+        value = state_info.get("state")
+        now = time.time()
+        with self._lock:
+            if device_id in self._values and self._values[device_id] == value:
+                return # 值没有变化，不可能产生条件跳变
+            self._values[device_id] = value
+            entries = self._index.get(device_id)
+            if not entries:
+                return
+            self._events_processed += 1
+            for rule, i in entries:
+                rule.condition_results[i] = rule.conditions[i].evaluate(value, rule.condition_results[i])
+                self._evaluations += 1
+                self._update_rule(rule, now)
+
+    def _update_rule(self, rule, now):
+        """根据条件结果更新规则状态 (调用者持有 self._lock)"""
+        results = rule.condition_results
+        matched = all(results) if rule.match == "all" else any(results)
+        if matched == rule.matched:
+            return
+        rule.matched = matched
+        rule.pending_token += 1
+        if matched:
+            if rule.debounce > 0:
+                self._timer_seq += 1
+                heapq.heappush(self._timers, (now + rule.debounce, self._timer_seq, rule.name, rule.pending_token))
+                self._timer_cond.notify()
+            else:
+                self._fire(rule, rule.actions)
+        elif rule.fired:
+            rule.fired = False
+            self._fire(rule, rule.otherwise, mark_fired=False)
+
+    def _fire(self, rule, actions, mark_fired=True):
+        """把规则动作放入执行队列 (调用者持有 self._lock)"""
+        if mark_fired:
+            rule.fired = True
+            rule.fire_count += 1
+        for device_id, state in actions:
+            self._actions.put((rule.name, device_id, state))
+
+    # --- 工作线程 ---
+    def start(self):
+        """订阅 DeviceManager 的状态变化并启动动作/定时器线程"""
+        self._stop_event.clear()
+        self.device_manager.add_state_listener(self.on_state_change)
+        self._threads = [threading.Thread(target=self._run_actions, daemon=True),
+                         threading.Thread(target=self._run_timers, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        print("RulesEngine: 已启动。")
+
+    def stop(self):
+        self._stop_event.set()
+        self.device_manager.remove_state_listener(self.on_state_change)
+        with self._lock:
+            self._timer_cond.notify_all()
+        self._actions.put(None)
+        for thread in self._threads:
+            thread.join(timeout=2)
+        print("RulesEngine: 已停止。")
+
+    def _run_timers(self):
+        """防抖定时器线程：到期时如果条件仍然成立 (token 未变) 则触发动作"""
+        with self._lock:
+            while not self._stop_event.is_set():
+                profiler.checkpoint()
+                if not self._timers:
+                    self._timer_cond.wait(1.0)
+                    continue
+                deadline, _, name, token = self._timers[0]
+                delay = deadline - time.time()
+                if delay > 0:
+                    self._timer_cond.wait(min(delay, 1.0))
+                    continue
+                heapq.heappop(self._timers)
+                rule = self._rules.get(name)
+                if rule and rule.pending_token == token and rule.matched and not rule.fired:
+                    self._fire(rule, rule.actions)
+        profiler.release()
+
+    def _run_actions(self):
+        """动作线程：调用 DeviceManager 设置设备状态 (已经处于目标状态的跳过)"""
+        while not self._stop_event.is_set():
+            item = self._actions.get()
+            profiler.checkpoint()
+            if item is None:
+                break
+            rule_name, device_id, state = item
+            cached = self.device_manager.get_cached_state(device_id)
+            if cached and cached["state"] == state:
+                continue
+            print(f"RulesEngine: 规则 '{rule_name}' 触发 -> 设置 {device_id} 为 {state}")
+            try:
+                if self.device_manager.set_device_state(device_id, state, priority=PRIORITY_SCHEDULED):
+                    self._actions_executed += 1
+                else:
+                    print(f"RulesEngine Warning: 规则 '{rule_name}' 设置 {device_id} 失败。")
+            except Exception as e:
+                print(f"RulesEngine Error: 执行规则 '{rule_name}' 的动作时出错: {e}")
+        profiler.release()
+
+    def get_stats(self):
+        with self._lock:
+            return {"rules": len(self._rules),
+                    "indexed_devices": len(self._index),
+                    "events_processed": self._events_processed,
+                    "condition_evaluations": self._evaluations,
+                    "actions_executed": self._actions_executed,
+                    "pending_timers": len(self._timers)}
+
+
+# --- 测试代码 / 单次事件开销测量 ---
+if __name__ == "__main__":
+    import random
+
+    class _RecordingManager:
+        """只记录动作的假 DeviceManager，用于离线测量"""
+        def __init__(self):
+            self.listeners = []
+            self.states = {}
+        def add_state_listener(self, callback): self.listeners.append(callback)
+        def remove_state_listener(self, callback): self.listeners.remove(callback)
+        def get_cached_state(self, device_id):
+            return {"state": self.states[device_id]} if device_id in self.states else None
+        def set_device_state(self, device_id, state, **kwargs):
+            self.states[device_id] = state
+            return True
+
+    NUM_SENSORS = 1000
+    NUM_EVENTS = 20000
+    for num_rules in (100, 1000, 10000):
+        engine = RulesEngine(_RecordingManager())
+        for r in range(num_rules):
+            engine.add_rule({"name": f"rule_{r}",
+                             "when": [{"device_id": f"sensor_{r % NUM_SENSORS}", "op": ">", "value": 30, "hysteresis": 0.5}],
+                             "then": [{"device_id": f"socket_{r}", "state": "off"}],
+                             "debounce": 0})
+        values = [20.0 + random.random() * 15 for _ in range(NUM_EVENTS)]
+        start_time = time.perf_counter()
+        for n, value in enumerate(values):
+            engine.on_state_change(f"sensor_{n % NUM_SENSORS}", {"state": value})
+        elapsed = time.perf_counter() - start_time
+        stats = engine.get_stats()
+        print(f"{num_rules:>6} 条规则: 每事件 {elapsed / NUM_EVENTS * 1e6:.1f} us，"
+              f"平均每事件计算 {stats['condition_evaluations'] / max(stats['events_processed'], 1):.1f} 个条件")
+
+    # 防抖 + 回差演示
+    manager = _RecordingManager()
+    engine = RulesEngine(manager)
+    engine.add_rule({"name": "overheat",
+                     "when": [{"device_id": "sensor_temp_main", "op": ">", "value": 30, "hysteresis": 0.5}],
+                     "then": [{"device_id": "socket_kitchen", "state": "off"}],
+                     "otherwise": [{"device_id": "socket_kitchen", "state": "on"}],
+                     "debounce": 0.2})
+    engine.start()
+    for value in (29.0, 30.5, 29.8, 30.2, 31.0):
+        engine.on_state_change("sensor_temp_main", {"state": value})
+    time.sleep(0.5)
+    print(f"防抖后 socket_kitchen = {manager.states.get('socket_kitchen')} (期望 off)")
+    engine.on_state_change("sensor_temp_main", {"state": 29.6}) # 仍在回差范围内
+    time.sleep(0.1)
+    print(f"29.6 时 socket_kitchen = {manager.states.get('socket_kitchen')} (期望 off)")
+    engine.on_state_change("sensor_temp_main", {"state": 29.4})
+    time.sleep(0.1)
+    print(f"29.4 时 socket_kitchen = {manager.states.get('socket_kitchen')} (期望 on)")
+    engine.stop()
@@ -0,0 +1,237 @@
+# sensor_poller.py
+import heapq
+import threading
+import time
+
+from admission import DeviceBusyError, PRIORITY_BULK
+from profiler import profiler
+
+class AdaptiveInterval:
+    """
+    单个传感器的自适应轮询间隔。
+    与 "参考值" (上一次间隔调整时的读数) 比较：变化超过 change_threshold 说明温度正在变化，
+    间隔减半 (不低于 min_interval) 并更新参考值；否则间隔乘以 backoff (不超过 max_interval)。
+    与参考值而不是上一次读数比较，是为了让读数间的小幅噪声不会误触发加速，而缓慢累积的漂移最终仍然能被发现。
+    注意驱动 simulate_sensor_update 模拟的传感器不是噪声：读数只在读取时变化，每次平均下降 0.2 度直到 10.0 度下限
+    (见下方测试代码的 DriverSensor)。
+    """
+    def __init__(self, min_interval, max_interval, change_threshold, backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.change_threshold = change_threshold
+        self.backoff = backoff
+        self.interval = min_interval
+        self.reference = None
+
+    def update(self, value):
+        """记录一次读数，返回下一次轮询前应等待的秒数"""
+        if not isinstance(value, (int, float)):
+            return self.interval # 无法解析的读数，保持当前间隔
+        if self.reference is None:
+            self.reference = value
+        elif abs(value - self.reference) >= self.change_threshold:
+            self.reference = value
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return self.interval
+
+class AdaptiveSensorPoller:
+    """
+    DeviceManager 的后台传感器轮询线程。
+    每个传感器按自己的自适应间隔读取 (走批量读取优先级)，读数写入 DeviceManager 的状态缓存，
+    客户端的 get 在缓存足够新时直接返回缓存，很少访问设备。
+    """
+    def __init__(self, device_manager, device_ids, min_interval=5.0, max_interval=120.0,
+                 change_threshold=0.3, baseline_interval=30.0):
+        """
+        :param device_ids: 需要轮询的传感器 ID 列表
+        :param min_interval: 温度变化时的最短轮询间隔 (秒)
+        :param max_interval: 温度稳定时的最长轮询间隔 (秒)
+        :param change_threshold: 被视为 "正在变化" 的温度变化量
+        :param baseline_interval: 用于对比的固定轮询间隔 (原 read_sensor_task 为 30 秒)
+        """
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("需要 0 < min_interval <= max_interval")
+        self.device_manager = device_manager
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.baseline_interval = baseline_interval
+        self.change_threshold = change_threshold
+        self._intervals = {device_id: AdaptiveInterval(min_interval, max_interval, change_threshold)
+                           for device_id in device_ids}
+        self._schedule = [(0.0, device_id) for device_id in device_ids] # 堆 [(下次轮询时间, device_id)]
+        heapq.heapify(self._schedule)
+        self._added = [] # add_sensors 加入、尚未进入调度堆的传感器 (由 _lock 保护，调度堆只由轮询线程访问)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._started_at = None
+        self._reads = 0
+        self._failures = 0
+
+    def start(self):
+        self._started_at = time.monotonic()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        print(f"SensorPoller: 已启动，轮询 {len(self._intervals)} 个传感器 "
+              f"(间隔 {self.min_interval:g}-{self.max_interval:g} 秒)。")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        print("SensorPoller: 已停止。")
+
+    def add_sensors(self, device_ids):
+        """加入新发现的传感器，轮询线程在下一次循环时开始读取它们"""
+        with self._lock:
+            for device_id in device_ids:
+                if device_id not in self._intervals:
+                    self._intervals[device_id] = AdaptiveInterval(self.min_interval, self.max_interval,
+                                                                  self.change_threshold)
+                    self._added.append(device_id)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            profiler.checkpoint()
+            with self._lock:
+                added, self._added = self._added, []
+            for device_id in added:
+                heapq.heappush(self._schedule, (0.0, device_id))
+            if not self._schedule:
+                break
+            due, device_id = self._schedule[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._stop_event.wait(delay)
+                continue
+            heapq.heappop(self._schedule)
+            try:
+                state_info = self.device_manager.get_device_state(device_id, priority=PRIORITY_BULK, max_age=0)
+            except DeviceBusyError:
+                state_info = None # 批量通道已满，让位给更高优先级的操作
+            except Exception as e:
+                print(f"SensorPoller Error: 轮询 {device_id} 时出错: {e}")
+                state_info = None
+            with self._lock:
+                tracker = self._intervals[device_id]
+                if state_info:
+                    self._reads += 1
+                    interval = tracker.update(state_info["state"])
+                else:
+                    self._failures += 1
+                    interval = tracker.interval
+            heapq.heappush(self._schedule, (time.monotonic() + interval, device_id))
+        profiler.release()
+
+    def is_polled(self, device_id):
+        return device_id in self._intervals
+
+    def get_max_age(self, device_id):
+        """
+        缓存对该传感器可以接受的最大年龄：当前轮询间隔 (加一点余量，轮询可能因排队略有延迟)。
+        不是被轮询的设备返回 None。
+        """
+        tracker = self._intervals.get(device_id)
+        if tracker is None:
+            return None
+        return tracker.interval * 1.5
+
+    def get_stats(self):
+        """返回实际读取次数/小时，以及相同传感器数下固定间隔轮询的基线"""
+        with self._lock:
+            elapsed = max(time.monotonic() - self._started_at, 1e-9) if self._started_at else 0.0
+            num_sensors = len(self._intervals)
+            return {
+                "sensors": num_sensors,
+                "reads": self._reads,
+                "failures": self._failures,
+                "elapsed_seconds": round(elapsed, 1),
+                "reads_per_hour": round(self._reads * 3600 / elapsed, 1) if elapsed else 0.0,
+                "baseline_reads_per_hour": round(num_sensors * 3600 / self.baseline_interval, 1),
+                "min_interval_reads_per_hour": round(num_sensors * 3600 / self.min_interval, 1),
+                "intervals": {device_id: round(tracker.interval, 1) for device_id, tracker in self._intervals.items()},
+            }
+
+
+# --- 测试代码: 用模拟时间比较自适应轮询与固定间隔轮询 ---
+if __name__ == "__main__":
+    import random
+
+    random.seed(1)
+    DAY = 86400
+    STRATEGIES = (("自适应 5-120 秒", None), ("固定 5 秒", 5), ("固定 30 秒 (原调度任务)", 30))
+
+    class DriverSensor:
+        """
+        smart_device_driver.c 中 simulate_sensor_update 的忠实模型：读数只在被读取时变化 (随机游走)。
+        每次读取: change 为随机的有符号 long，C 的 % 向零截断，(change % 5) - 2 取值 -6..+2 (-2 的概率为 1/5，
+        其余各 1/10)，平均 -2，即每次读取平均下降 0.2 度；结果限制在 10.0-35.0 度，初始值 22.5 度。
+        """
+        def __init__(self, scaled=225):
+            self.scaled = scaled
+
+        def read(self):
+            change = random.getrandbits(64) - 2 ** 63
+            remainder = abs(change) % 5
+            self.scaled += (remainder if change >= 0 else -remainder) - 2
+            self.scaled = min(350, max(100, self.scaled))
+            return self.scaled / 10
+
+    def simulate_driver(next_interval):
+        """返回 (读取次数, 降到下限 10.0 度所用的读取次数, 降到下限所用的秒数)"""
+        sensor = DriverSensor()
+        t, reads, floor_reads, floor_time = 0.0, 0, None, None
+        while t < DAY:
+            value = sensor.read()
+            reads += 1
+            if floor_reads is None and value <= 10.0:
+                floor_reads, floor_time = reads, t
+            t += next_interval(value)
+        return reads, floor_reads, floor_time
+
+    print("驱动模型 (simulate_sensor_update): 读数只在读取时变化，两次读取之间缓存与设备值一致 (缓存误差为 0)")
+    for label, interval in STRATEGIES:
+        tracker = AdaptiveInterval(min_interval=5, max_interval=120, change_threshold=0.3)
+        reads, floor_reads, floor_time = simulate_driver(tracker.update if interval is None else lambda value: interval)
+        print(f"  {label:<22} 每小时读取 {reads / 24:7.1f} 次，第 {floor_reads} 次读取 "
+              f"({floor_time / 60:.1f} 分钟) 降到下限 10.0 度")
+
+    def true_temperature(t):
+        """一天的温度曲线：大部分时间稳定在 22 度，早晚各有一段 15 分钟的快速升温/降温 (每分钟 0.2 度)"""
+        hour = t / 3600
+        if 7 <= hour < 7.25:
+            return 22 + 12 * (hour - 7)
+        if 7.25 <= hour < 18:
+            return 25
+        if 18 <= hour < 18.25:
+            return 25 - 12 * (hour - 18)
+        return 22
+
+    def read_synthetic(t):
+        # 合成传感器 (不是驱动模型): 真实温度随时间变化，每次读取叠加独立的 -0.2 ~ +0.2 噪声
+        return round(true_temperature(t) + random.choice((-0.2, -0.1, 0, 0.1, 0.2)), 1)
+
+    def simulate_synthetic(next_interval):
+        """返回 (读取次数, 缓存值与真实温度的最大偏差)"""
+        t, reads, worst = 0.0, 0, 0.0
+        checkpoints = iter(range(0, DAY, 10)) # 每 10 秒检查一次缓存的误差
+        check = next(checkpoints)
+        while t < DAY:
+            value = read_synthetic(t)
+            reads += 1
+            wait = next_interval(value)
+            while check is not None and check < t + wait:
+                if check >= t:
+                    worst = max(worst, abs(value - true_temperature(check)))
+                check = next(checkpoints, None)
+            t += wait
+        return reads, worst
+
+    print("合成传感器 (22 度稳定，早晚各 15 分钟每分钟 0.2 度的升降温，每次读取独立 ±0.2 度噪声):")
+    for label, interval in STRATEGIES:
+        tracker = AdaptiveInterval(min_interval=5, max_interval=120, change_threshold=0.3)
+        reads, worst = simulate_synthetic(tracker.update if interval is None else lambda value: interval)
+        print(f"  {label:<22} 每小时读取 {reads / 24:7.1f} 次，缓存最大偏差 {worst:.2f} 度")
@@ -0,0 +1,338 @@
+# sensor_rollup.py
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from bisect import bisect_left
+
+RESOLUTIONS = {"minute": 60, "hour": 3600}
+# 每个汇总粒度一组定长列文件，一行对应一个时间桶；ts 列必须最后追加 (读者以 ts 列长度为行数)
+COLUMNS = (("min", "d"), ("max", "d"), ("sum", "d"), ("count", "q"), ("ts", "q"))
+ID_FILE_NAME = "device_id" # 传感器目录中记录原始设备 ID (目录名经过 _safe_name 替换)
+
+def _safe_name(device_id):
+    return re.sub(r"[^A-Za-z0-9_.:-]", "_", device_id)
+
+class _Bucket:
+    __slots__ = ("ts", "min", "max", "sum", "count")
+
+    def __init__(self, ts, value):
+        self.ts = ts
+        self.min = self.max = self.sum = value
+        self.count = 1
+
+    def add(self, value):
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+
+class _ColumnSeries:
+    """
+    一个传感器在一个粒度下的汇总序列：目录中的 ts/min/max/sum/count 五个列文件，每行一个时间桶，
+    按时间戳递增只追加。正在累积的当前桶在内存中，checkpoint() 把它写成 (或覆盖) 文件的最后一行，
+    进入下一个桶或关闭时最终写入。
+    """
+    def __init__(self, directory, resolution):
+        self.directory = directory
+        self.resolution = resolution
+        os.makedirs(directory, exist_ok=True)
+        self.paths = {name: os.path.join(directory, f"{name}.{code}") for name, code in COLUMNS}
+        self._repair()
+        self.fds = {name: os.open(path, os.O_RDWR | os.O_CREAT, 0o644) for name, path in self.paths.items()}
+        self.rows = os.path.getsize(self.paths["ts"]) // 8
+        self.last_ts = self._read_last_ts()
+        self.current = None      # 内存中的当前桶
+        self.current_row = None  # 当前桶已由 checkpoint 写入的行号 (之后覆盖该行)，尚未写入时为 None
+
+    def _repair(self):
+        """崩溃可能让各列长度不一致：截断到所有列都完整的行数"""
+        sizes = {name: os.path.getsize(path) if os.path.exists(path) else 0 for name, path in self.paths.items()}
+        rows = min(sizes.values()) // 8
+        for name, path in self.paths.items():
+            if sizes[name] != rows * 8:
+                with open(path, "ab") as f:
+                    f.truncate(rows * 8)
+
+    def _read_last_ts(self):
+        if not self.rows:
+            return None
+        with open(self.paths["ts"], "rb") as f:
+            f.seek((self.rows - 1) * 8)
+            return struct.unpack("=q", f.read(8))[0]
+
+    def add(self, timestamp, value):
+        """加入一个读数；早于当前桶的迟到读数返回 False (不破坏文件的时间顺序)"""
+        ts = int(timestamp // self.resolution) * self.resolution
+        current = self.current
+        if current is not None and ts == current.ts:
+            current.add(value)
+            return True
+        if (current is not None and ts < current.ts) or (self.last_ts is not None and ts < self.last_ts):
+            return False
+        self.flush()
+        self.current = _Bucket(ts, value)
+        return True
+
+    def checkpoint(self):
+        """
+        把当前桶写入列文件但继续在内存中累积：第一次追加一行，之后覆盖同一行，崩溃时最多丢失一个 checkpoint
+        间隔的读数。
+        """
+        bucket = self.current
+        if bucket is None:
+            return
+        values = {"min": bucket.min, "max": bucket.max, "sum": bucket.sum, "count": bucket.count, "ts": bucket.ts}
+        row = self.rows if self.current_row is None else self.current_row
+        for name, code in COLUMNS: # ts 列最后写，读者看到的每一行其余列都已完整 (覆盖时 ts 不变)
+            os.pwrite(self.fds[name], struct.pack("=" + code, values[name]), row * 8)
+        if self.current_row is None:
+            self.current_row = row
+            self.rows += 1
+            self.last_ts = bucket.ts
+
+    def flush(self):
+        """把当前桶最终写入列文件。同一个桶之后若再有读数会写成同一时间戳的新行，查询时合并。"""
+        self.checkpoint()
+        self.current = None
+        self.current_row = None
+
+    def read_range(self, start, end):
+        """
+        返回 [start, end) 内各行的 (ts, min, max, sum, count) 列表 (已最终写入文件的部分，不含当前桶的 checkpoint 行)。
+        mmap ts 列后在 memoryview 上二分查找，只把命中范围内的行转换为 Python 对象。
+        """
+        rows = self.rows if self.current_row is None else self.current_row
+        if not rows:
+            return [], [], [], [], []
+        maps = []
+        try:
+            views = {}
+            for name, code in COLUMNS:
+                with open(self.paths[name], "rb") as f:
+                    mm = mmap.mmap(f.fileno(), rows * 8, access=mmap.ACCESS_READ)
+                maps.append(mm)
+                views[name] = memoryview(mm).cast(code)
+            ts_view = views["ts"]
+            lo = bisect_left(ts_view, start) if start is not None else 0
+            hi = bisect_left(ts_view, end, lo) if end is not None else rows
+            result = tuple(views[name][lo:hi].tolist() for name in ("ts", "min", "max", "sum", "count"))
+            for view in views.values():
+                view.release()
+            return result
+        finally:
+            for mm in maps:
+                mm.close()
+
+    def close(self):
+        self.flush()
+        for fd in self.fds.values():
+            os.close(fd)
+
+class SensorRollupStore:
+    """
+    传感器读数的长期汇总存储 (用于能耗分析等跨月查询)。
+    每个传感器按分钟和小时汇总 min/max/sum/count，存为定长、只追加的列文件：
+        <data_dir>/<device_id>/<粒度秒数>/{ts.q, min.d, max.d, sum.d, count.q}
+    范围查询 mmap 时间戳列并二分查找，不解析任何文本；90 天的小时汇总只有 2160 行。
+    通过 DeviceManager 的状态监听器接收读数 (on_state_change)，只记录数值型状态。
+    后台线程每 checkpoint_interval 秒把各序列正在累积的当前桶写入文件 (覆盖最后一行)，0 表示不启动。
+    """
+    def __init__(self, data_dir, resolutions=tuple(RESOLUTIONS.values()), checkpoint_interval=10.0):
+        self.data_dir = data_dir
+        self.resolutions = tuple(resolutions)
+        self.checkpoint_interval = checkpoint_interval
+        os.makedirs(data_dir, exist_ok=True)
+        self._series = {}     # (目录名, resolution) -> _ColumnSeries；目录名即 _safe_name(device_id)
+        self._device_ids = {} # 目录名 -> 原始设备 ID
+        self._lock = threading.Lock()
+        self._readings = 0
+        self._late_readings = 0
+        for name in sorted(os.listdir(data_dir)):
+            directory = os.path.join(data_dir, name)
+            if os.path.isdir(directory):
+                try:
+                    with open(os.path.join(directory, ID_FILE_NAME), encoding="utf-8") as f:
+                        device_id = f.read()
+                except FileNotFoundError:
+                    device_id = name
+                for resolution in self.resolutions:
+                    self._get_series(device_id, resolution)
+        print(f"SensorRollupStore: 数据目录 {data_dir}，已有 {len(self.list_sensors())} 个传感器的汇总。")
+        self._stop_event = threading.Event()
+        self._checkpoint_thread = None
+        if checkpoint_interval > 0:
+            self._checkpoint_thread = threading.Thread(target=self._run_checkpoint, daemon=True)
+            self._checkpoint_thread.start()
+
+    def _get_series(self, device_id, resolution):
+        """按目录名 (而不是原始 ID) 查找，替换字符后相同的 ID 共用同一组文件，也只对应一个序列对象"""
+        name = _safe_name(device_id)
+        key = (name, resolution)
+        series = self._series.get(key)
+        if series is None:
+            directory = os.path.join(self.data_dir, name)
+            if name not in self._device_ids:
+                os.makedirs(directory, exist_ok=True)
+                id_path = os.path.join(directory, ID_FILE_NAME)
+                if not os.path.exists(id_path):
+                    with open(id_path, "w", encoding="utf-8") as f:
+                        f.write(device_id)
+                self._device_ids[name] = device_id
+            series = self._series[key] = _ColumnSeries(os.path.join(directory, str(resolution)), resolution)
+        return series
+
+    def add(self, device_id, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            self._readings += 1
+            for resolution in self.resolutions:
+                if not self._get_series(device_id, resolution).add(timestamp, value):
+                    self._late_readings += 1
+
+    def on_state_change(self, device_id, state_info, previous):
+        """
+        DeviceManager 状态监听器：记录数值型读数 (传感器)，忽略开关类状态。
+        last_updated 与上一次相同的是同一个读数被再次观测到，不重复计入。
+        """
+        value = state_info.get("state")
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return
+        if previous is not None and previous.get("last_updated") == state_info.get("last_updated"):
+            return
+        self.add(device_id, float(value), state_info.get("last_updated"))
+
+    def checkpoint(self):
+        """把所有正在累积的当前桶写入文件 (不 fsync，进程崩溃时数据已在 OS 缓冲中)"""
+        with self._lock:
+            for series in self._series.values():
+                series.checkpoint()
+
+    def _run_checkpoint(self):
+        while not self._stop_event.wait(self.checkpoint_interval):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                print(f"SensorRollupStore Error: 写入当前桶时出错: {e}")
+
+    def query(self, device_id, start=None, end=None, resolution=3600):
+        """
+        查询 [start, end) 内的汇总，包括内存中尚未写入文件的当前桶。同一时间戳的多行 (重启或关闭时写出的
+        不完整桶) 合并为一行。
+        :return: {"timestamps": [...], "min": [...], "max": [...], "avg": [...], "count": [...], "summary": {...}}
+        :raises ValueError: 不支持的汇总粒度
+        """
+        if resolution not in self.resolutions:
+            raise ValueError(f"不支持的汇总粒度 {resolution} 秒，可选: {self.resolutions}")
+        with self._lock:
+            series = self._series.get((_safe_name(device_id), resolution))
+            if series is None:
+                ts, mins, maxs, sums, counts = [], [], [], [], []
+            else:
+                ts, mins, maxs, sums, counts = series.read_range(start, end)
+                current = series.current
+                if current is not None and (start is None or current.ts >= start) and (end is None or current.ts < end):
+                    ts.append(current.ts); mins.append(current.min); maxs.append(current.max)
+                    sums.append(current.sum); counts.append(current.count)
+
+        merged_ts, merged_min, merged_max, merged_sum, merged_count = [], [], [], [], []
+        for i in range(len(ts)):
+            if merged_ts and merged_ts[-1] == ts[i]:
+                merged_min[-1] = min(merged_min[-1], mins[i])
+                merged_max[-1] = max(merged_max[-1], maxs[i])
+                merged_sum[-1] += sums[i]
+                merged_count[-1] += counts[i]
+            else:
+                merged_ts.append(ts[i]); merged_min.append(mins[i]); merged_max.append(maxs[i])
+                merged_sum.append(sums[i]); merged_count.append(counts[i])
+
+        total_count = sum(merged_count)
+        summary = {"buckets": len(merged_ts), "count": total_count,
+                   "min": min(merged_min) if merged_min else None,
+                   "max": max(merged_max) if merged_max else None,
+                   "avg": sum(merged_sum) / total_count if total_count else None}
+        return {"device_id": device_id, "resolution": resolution,
+                "timestamps": merged_ts, "min": merged_min, "max": merged_max,
+                "avg": [s / c for s, c in zip(merged_sum, merged_count)], "count": merged_count,
+                "summary": summary}
+
+    def list_sensors(self):
+        with self._lock:
+            return sorted(self._device_ids.values())
+
+    def get_stats(self):
+        with self._lock:
+            return {"sensors": len(self._device_ids),
+                    "readings": self._readings, "late_readings": self._late_readings,
+                    "rows": {f"{self._device_ids[name]}/{resolution}": series.rows
+                             for (name, resolution), series in self._series.items()}}
+
+    def close(self):
+        """停止后台线程，写出所有当前桶并关闭文件"""
+        self._stop_event.set()
+        if self._checkpoint_thread and self._checkpoint_thread.is_alive():
+            self._checkpoint_thread.join(timeout=5)
+        with self._lock:
+            for series in self._series.values():
+                series.close()
+            self._series = {}
+            self._device_ids = {}
+
+
+# --- 测试代码: 写入 90 天的模拟读数，测量查询耗时 ---
+if __name__ == "__main__":
+    import math
+    import random
+    import shutil
+    import tempfile
+
+    data_dir = tempfile.mkdtemp(prefix="rollup_bench_")
+    try:
+        store = SensorRollupStore(data_dir)
+        now = time.time()
+        start = now - 90 * 86400
+        interval = 30 # 每 30 秒一个读数
+        write_start = time.perf_counter()
+        t = start
+        while t < now:
+            daily = 3 * math.sin((t % 86400) / 86400 * 2 * math.pi)
+            store.add("sensor_temp_main", round(22 + daily + random.uniform(-0.2, 0.2), 1), t)
+            t += interval
+        write_seconds = time.perf_counter() - write_start
+        readings = store.get_stats()["readings"]
+        print(f"写入 {readings} 个读数 (90 天，每 {interval} 秒一个)，耗时 {write_seconds:.2f} 秒 "
+              f"({readings / write_seconds:,.0f} 个/秒)")
+
+        # 模拟重启: 关闭时写出不完整的当前桶，重新打开后同一个桶的新读数写成同一时间戳的新行
+        store.close()
+        store = SensorRollupStore(data_dir)
+        store.add("sensor_temp_main", 22.0, now)
+        print(f"行数: {store.get_stats()['rows']}")
+
+        for label, resolution, days in (("最近 90 天每小时", 3600, 90), ("最近 24 小时每分钟", 60, 1)):
+            timings = []
+            for _ in range(50):
+                query_start = time.perf_counter()
+                result = store.query("sensor_temp_main", now - days * 86400, now + 1, resolution)
+                timings.append(time.perf_counter() - query_start)
+            timings.sort()
+            summary = result["summary"]
+            print(f"{label}: {summary['buckets']} 个桶，平均 {summary['avg']:.2f} 度 "
+                  f"(最低 {summary['min']}，最高 {summary['max']})，查询 p50 {timings[25] * 1000:.2f} ms")
+
+        # 对比: 从原始读数计算同样的小时平均 (相当于保存原始读数后每次查询都重新聚合)
+        raw = [(start + i * interval, 22.0) for i in range(readings)]
+        scan_start = time.perf_counter()
+        hourly = {}
+        for ts, value in raw:
+            bucket = hourly.setdefault(int(ts // 3600), [0.0, 0])
+            bucket[0] += value
+            bucket[1] += 1
+        print(f"对比: 在内存中聚合 {len(raw)} 个原始读数耗时 {(time.perf_counter() - scan_start) * 1000:.0f} ms")
+        store.close()
+    finally:
+        shutil.rmtree(data_dir)
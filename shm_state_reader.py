@@ -0,0 +1,180 @@
+# shm_state_reader.py
+"""
+共享内存设备状态表的只读客户端 (供显示守护进程、指标导出器等本机进程使用)。
+不依赖控制器的其他模块，直接 mmap 控制器发布的状态表，无锁读取，不经过 TCP/JSON。
+
+表布局 (小端，固定宽度):
+  头部 (HEADER_SIZE 字节):  magic(4s) layout_version(H) slot_count(H) slot_size(I) device_count(I)
+  槽位 (SLOT_SIZE 字节 x slot_count):
+      seq(I)            seqlock 序号，奇数表示写入中
+      kind(B)           0=空槽, 1=字符串状态, 2=浮点状态, 3=已注册但尚未观测到状态
+      version(Q)        设备状态版本，每次状态变化加 1
+      last_updated(d)   状态观测时间戳
+      value_float(d)    kind=2 时的状态值
+      device_id(32s)    设备 ID (UTF-8，\\0 填充)
+      device_type(16s)  设备类型
+      value_str(32s)    kind=1 时的状态值
+"""
+import mmap
+import os
+import struct
+import time
+
+DEFAULT_PATH = "/dev/shm/smart_home_state"
+
+MAGIC = b"SHST"
+LAYOUT_VERSION = 1
+HEADER_FORMAT = "<4sHHII"
+HEADER_SIZE = 64
+SLOT_FORMAT = "<IB3xQdd32s16s32s16x"
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)   # 128
+SEQ_FORMAT = "<I"
+SLOT_BODY_FORMAT = "<B3xQdd32s16s32s16x"   # 槽位中 seq 之后的部分
+SLOT_BODY_OFFSET = struct.calcsize(SEQ_FORMAT)
+
+KIND_EMPTY = 0
+KIND_STR = 1
+KIND_FLOAT = 2
+KIND_UNKNOWN = 3
+
+class StateTableError(Exception):
+    """状态表不存在、格式不匹配或读取失败"""
+    pass
+
+def decode_field(raw):
+    """把 \\0 填充的定长字节字段解码为字符串"""
+    return raw.split(b"\0", 1)[0].decode('utf-8', errors='replace')
+
+class SharedStateReader:
+    """
+    状态表读者。读取采用 seqlock 协议：读 seq -> 读槽位 -> 再读 seq，
+    两次 seq 相同且为偶数才说明读到的是一致的快照，否则重试。读者从不加锁，也不会阻塞写者。
+    """
+    MAX_RETRIES = 100
+
+    def __init__(self, path=DEFAULT_PATH):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            raise StateTableError(f"无法打开状态表 {path}: {e}（控制器是否已启动？）")
+        try:
+            self._mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd) # mmap 持有自己的引用
+        magic, layout_version, self.slot_count, slot_size, _ = struct.unpack_from(HEADER_FORMAT, self._mm, 0)
+        if magic != MAGIC or layout_version != LAYOUT_VERSION or slot_size != SLOT_SIZE:
+            self._mm.close()
+            raise StateTableError(f"状态表 {path} 格式不匹配 (magic={magic!r}, version={layout_version})")
+        self.path = path
+        self._slots = {}           # device_id -> 槽位偏移
+        self._indexed_count = -1
+
+    def _refresh_index(self):
+        """设备数量变化时重新扫描槽位，建立 device_id -> 偏移 的索引"""
+        device_count = struct.unpack_from(HEADER_FORMAT, self._mm, 0)[4]
+        if device_count == self._indexed_count:
+            return
+        slots = {}
+        for i in range(self.slot_count):
+            offset = HEADER_SIZE + i * SLOT_SIZE
+            record = self._read_slot(offset)
+            if record is not None:
+                slots[record["device_id"]] = offset
+        self._slots = slots
+        self._indexed_count = device_count
+
+    def _read_slot(self, offset):
+        """按 seqlock 协议读取一个槽位，空槽返回 None"""
+        mm = self._mm
+        for attempt in range(self.MAX_RETRIES):
+            if attempt:
+                time.sleep(0) # 让出 CPU (和 GIL)，让被抢占的写者完成写入
+            seq_before = struct.unpack_from(SEQ_FORMAT, mm, offset)[0]
+            if seq_before & 1:
+                continue # 写者正在写，重试
+            kind, version, last_updated, value_float, device_id, device_type, value_str = \
+                struct.unpack_from(SLOT_BODY_FORMAT, mm, offset + SLOT_BODY_OFFSET)
+            if struct.unpack_from(SEQ_FORMAT, mm, offset)[0] != seq_before:
+                continue # 读取期间被修改，重试
+            if kind == KIND_EMPTY:
+                return None
+            return {
+                "device_id": decode_field(device_id),
+                "type": decode_field(device_type),
+                "state": (value_float if kind == KIND_FLOAT else
+                          None if kind == KIND_UNKNOWN else decode_field(value_str)),
+                "last_updated": last_updated,
+                "version": version,
+            }
+        raise StateTableError(f"读取槽位 {offset} 重试 {self.MAX_RETRIES} 次仍不一致")
+
+    def list_devices(self):
+        """返回 {device_id: device_type}"""
+        return {dev_id: info["type"] for dev_id, info in self.read_all().items()}
+
+    def read(self, device_id):
+        """
+        读取单个设备状态。
+        :return: {'state': ..., 'last_updated': ..., 'version': ..., 'type': ...}，未发布的设备返回 None
+        """
+        offset = self._slots.get(device_id)
+        if offset is None:
+            self._refresh_index()
+            offset = self._slots.get(device_id)
+            if offset is None:
+                return None
+        record = self._read_slot(offset)
+        if record is None or record["device_id"] != device_id:
+            # 表被控制器重建，槽位分配可能变化
+            self._indexed_count = -1
+            return None
+        del record["device_id"]
+        return record
+
+    def read_all(self):
+        """读取所有已发布设备的状态，返回 {device_id: {...}}"""
+        self._refresh_index()
+        states = {}
+        for device_id, offset in self._slots.items():
+            record = self._read_slot(offset)
+            if record is not None:
+                states[record.pop("device_id")] = record
+        return states
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# --- 命令行: 打印 (或持续刷新) 当前所有设备状态 ---
+if __name__ == "__main__":
+    import sys
+
+    path = DEFAULT_PATH
+    watch = False
+    for arg in sys.argv[1:]:
+        if arg == "--watch":
+            watch = True
+        else:
+            path = arg
+
+    try:
+        with SharedStateReader(path) as reader:
+            while True:
+                for device_id, info in sorted(reader.read_all().items()):
+                    ts = time.strftime('%H:%M:%S', time.localtime(info['last_updated']))
+                    print(f"  - {device_id} ({info['type']}): {info['state']} (更新于 {ts}, 版本 {info['version']})")
+                if not watch:
+                    break
+                time.sleep(1.0)
+                print("-" * 30)
+    except StateTableError as e:
+        print(f"错误: {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,141 @@
+# shm_state_table.py
+import mmap
+import os
+import struct
+import threading
+
+from shm_state_reader import (DEFAULT_PATH, MAGIC, LAYOUT_VERSION, HEADER_FORMAT, HEADER_SIZE,
+                              SLOT_SIZE, SEQ_FORMAT, SLOT_BODY_FORMAT, SLOT_BODY_OFFSET,
+                              KIND_STR, KIND_FLOAT, KIND_UNKNOWN, StateTableError)
+
+class SharedStateTable:
+    """
+    共享内存设备状态表 (写者端，由控制器持有)。
+    每个设备占用一个固定大小的槽位，写入时使用 seqlock：
+    seq 先加 1 (变为奇数) -> 写槽位内容 -> seq 再加 1 (变为偶数)。
+    读者 (shm_state_reader.SharedStateReader) 据此无锁地检测并重试不一致的读取。
+    布局定义见 shm_state_reader.py。
+    """
+    def __init__(self, path=DEFAULT_PATH, capacity=256):
+        """
+        创建 (或重建) 状态表文件并映射到内存。
+        :param path: 状态表文件路径，默认位于 /dev/shm (tmpfs)
+        :param capacity: 槽位数量 (最多可发布的设备数)
+        """
+        if not 0 < capacity <= 0xFFFF:
+            raise ValueError("capacity 必须在 1..65535 之间")
+        self.path = path
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * SLOT_SIZE
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            raise StateTableError(f"无法创建状态表 {path}: {e}")
+        try:
+            os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        # 清空旧内容，再写头部 (device_count 最后写，读者据此刷新索引)
+        self._mm[:] = bytes(size)
+        struct.pack_into(HEADER_FORMAT, self._mm, 0, MAGIC, LAYOUT_VERSION, capacity, SLOT_SIZE, 0)
+
+        self._slots = {}     # device_id -> (偏移, 类型)
+        self._lock = threading.Lock() # 写者之间互斥，读者不受影响
+        print(f"SharedStateTable: 已在 {path} 创建状态表 ({capacity} 个槽位, {size} 字节)。")
+
+    @staticmethod
+    def _encode(text, width):
+        data = str(text).encode('utf-8')
+        if len(data) > width:
+            raise ValueError(f"'{text}' 超过 {width} 字节")
+        return data
+
+    def register(self, device_id, device_type):
+        """为设备分配槽位 (已注册则直接返回)"""
+        with self._lock:
+            if device_id in self._slots:
+                return
+            if len(self._slots) >= self.capacity:
+                raise StateTableError(f"状态表已满 ({self.capacity} 个槽位)，无法发布 {device_id}")
+            offset = HEADER_SIZE + len(self._slots) * SLOT_SIZE
+            self._slots[device_id] = (offset, device_type)
+            self._write_slot(offset, KIND_UNKNOWN, 0, 0.0, 0.0, device_id, device_type, "")
+            struct.pack_into("<I", self._mm, 12, len(self._slots)) # 头部 device_count 字段
+
+    def update(self, device_id, state_info, version):
+        """
+        发布设备的最新状态。
+        :param state_info: {'state': ..., 'last_updated': ...}
+        :param version: 设备状态版本号
+        """
+        entry = self._slots.get(device_id)
+        if entry is None:
+            return False
+        offset, device_type = entry
+        state = state_info["state"]
+        if isinstance(state, float):
+            kind, value_float, value_str = KIND_FLOAT, state, ""
+        else:
+            kind, value_float, value_str = KIND_STR, 0.0, str(state)[:32]
+        with self._lock:
+            self._write_slot(offset, kind, version, state_info["last_updated"], value_float,
+                             device_id, device_type, value_str)
+        return True
+
+    def _write_slot(self, offset, kind, version, last_updated, value_float, device_id, device_type, value_str):
+        """seqlock 写入 (调用者持有 self._lock)"""
+        mm = self._mm
+        seq = struct.unpack_from(SEQ_FORMAT, mm, offset)[0]
+        struct.pack_into(SEQ_FORMAT, mm, offset, (seq + 1) & 0xFFFFFFFF)  # 奇数: 写入中
+        struct.pack_into(SLOT_BODY_FORMAT, mm, offset + SLOT_BODY_OFFSET, kind, version, last_updated,
+                         value_float, self._encode(device_id, 32), self._encode(device_type, 16),
+                         value_str.encode('utf-8')[:32])
+        struct.pack_into(SEQ_FORMAT, mm, offset, (seq + 2) & 0xFFFFFFFF)  # 偶数: 写入完成
+
+    def close(self):
+        with self._lock:
+            self._mm.flush()
+            self._mm.close()
+        print(f"SharedStateTable: 已关闭 {self.path}。")
+
+
+# --- 测试代码: 一个写线程持续更新，主线程并发读取并校验一致性 ---
+if __name__ == "__main__":
+    import tempfile
+    import time
+    from shm_state_reader import SharedStateReader
+
+    path = os.path.join(tempfile.gettempdir(), "smart_home_state_test")
+    table = SharedStateTable(path, capacity=16)
+    table.register("light_livingroom", "light")
+    table.register("sensor_temp_main", "sensor_temp")
+    stop = threading.Event()
+
+    def writer():
+        version = 0
+        while not stop.is_set():
+            version += 1
+            # 把版本号编码进状态值，读者据此校验读到的是同一次写入
+            table.update("sensor_temp_main", {"state": float(version), "last_updated": float(version)}, version)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    reader = SharedStateReader(path)
+    reads, torn = 0, 0
+    deadline = time.time() + 1.0
+    while time.time() < deadline:
+        info = reader.read("sensor_temp_main")
+        reads += 1
+        if info["version"] and (info["state"] != float(info["version"]) or info["last_updated"] != info["state"]):
+            torn += 1
+    stop.set()
+    thread.join()
+    print(f"1 秒内读取 {reads} 次，不一致的读取 {torn} 次 (期望 0)")
+    start = time.perf_counter()
+    for _ in range(100000):
+        reader.read("light_livingroom")
+    print(f"单次读取耗时 {(time.perf_counter() - start) * 10:.2f} us")
+    reader.close()
+    table.close()
+    os.remove(path)
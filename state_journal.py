@@ -0,0 +1,360 @@
+# state_journal.py
+import os
+import json
+import shutil
+import time
+import threading
+from collections import deque
+
+class StateJournal:
+    """
+    设备状态日志 (追加写 journal + 周期性快照)。
+    - 每次状态变化/传感器读数以一行 JSON 追加到 journal.log
+    - 后台线程按批次 fsync (durability 模式可配置)
+    - 周期性把内存中的物化视图压缩写入 snapshot.json，并轮换 journal
+    - 启动时只需加载最新快照并重放其后的 journal 尾部
+    """
+
+    # none:   只写入 OS 缓冲，由后台线程定期 flush，不 fsync (最快，掉电可能丢数据)
+    # batch:  后台线程每 fsync_interval 秒批量 fsync 一次 (默认)
+    # always: 每条记录写入后立即 fsync (最安全，最慢)
+    DURABILITY_MODES = ("none", "batch", "always")
+
+    JOURNAL_NAME = "journal.log"
+    PREV_JOURNAL_NAME = "journal.log.prev"
+    TAIL_JOURNAL_NAME = "journal.log.tail" # prev 已存在时轮换出的 journal，在锁外合并进 prev
+    SNAPSHOT_NAME = "snapshot.json"
+
+    def __init__(self, data_dir, durability="batch", fsync_interval=1.0,
+                 snapshot_interval=300.0, snapshot_every=50000, history_retention=86400.0):
+        """
+        初始化状态日志。
+        :param data_dir: 存放 journal 和快照的目录
+        :param durability: 持久化模式，见 DURABILITY_MODES
+        :param fsync_interval: batch 模式下两次 fsync 之间的间隔 (秒)
+        :param snapshot_interval: 两次快照之间的最长间隔 (秒)，<= 0 表示不按时间触发
+        :param snapshot_every: 自上次快照以来追加的记录数达到此值时触发快照，<= 0 表示不按数量触发
+        :param history_retention: 传感器历史保留时长 (秒)
+        """
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"无效的 durability 模式 '{durability}'，可选: {self.DURABILITY_MODES}")
+        self.data_dir = data_dir
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_every = snapshot_every
+        self.history_retention = history_retention
+
+        os.makedirs(self.data_dir, exist_ok=True)
+        self._journal_path = os.path.join(self.data_dir, self.JOURNAL_NAME)
+        self._prev_journal_path = os.path.join(self.data_dir, self.PREV_JOURNAL_NAME)
+        self._tail_journal_path = os.path.join(self.data_dir, self.TAIL_JOURNAL_NAME)
+        self._snapshot_path = os.path.join(self.data_dir, self.SNAPSHOT_NAME)
+
+        # 物化视图: 每个设备的最新状态 + 每个传感器的历史读数
+        self._devices = {}   # device_id -> {"state": ..., "last_updated": ...}
+        self._history = {}   # device_id -> deque[(ts, value)]
+        self._seq = 0        # 最后一条记录的序号
+
+        self._lock = threading.Lock()            # 保护物化视图和 journal 文件句柄
+        self._snapshot_lock = threading.Lock()   # 同一时间只允许一个快照
+        self._journal_file = None
+        self._dirty = False                      # 是否有尚未 fsync 的数据
+        self._records_since_snapshot = 0
+        self._last_snapshot_time = time.time()
+
+        self._stop_event = threading.Event()
+        self._flusher_thread = None
+        self._recovered = False
+
+    # --- 恢复 ---
+    def recover(self):
+        """
+        从磁盘恢复状态：加载最新快照，再按序号重放 journal 尾部。
+        必须在 start() / append 之前调用一次。
+        :return: 字典 {"devices": {...}, "history": {...}, "seq": ..., "replayed": ...}
+        """
+        start_time = time.time()
+        snapshot_seq = 0
+        if os.path.exists(self._snapshot_path):
+            try:
+                with open(self._snapshot_path, 'r') as f:
+                    snapshot = json.load(f)
+                snapshot_seq = snapshot.get("seq", 0)
+                self._devices = snapshot.get("devices", {})
+                self._history = {dev_id: deque(tuple(item) for item in readings)
+                                 for dev_id, readings in snapshot.get("history", {}).items()}
+            except (OSError, ValueError) as e:
+                # 快照是原子替换写入的，理论上不会半截；如果仍然损坏，只能依赖 journal
+                print(f"StateJournal Warning: 无法加载快照 {self._snapshot_path}: {e}")
+                self._devices, self._history, snapshot_seq = {}, {}, 0
+        self._seq = snapshot_seq
+
+        replayed = 0
+        # 先重放上一次轮换留下的旧 journal (快照写入前崩溃的情况)，再重放当前 journal
+        for path in (self._prev_journal_path, self._tail_journal_path, self._journal_path):
+            replayed += self._replay_file(path)
+
+        self._recovered = True
+        elapsed = time.time() - start_time
+        print(f"StateJournal: 恢复完成，快照 seq={snapshot_seq}，重放 {replayed} 条记录，"
+              f"共 {len(self._devices)} 个设备，耗时 {elapsed * 1000:.1f} ms。")
+        return {
+            "devices": {dev_id: dict(info) for dev_id, info in self._devices.items()},
+            "history": {dev_id: list(readings) for dev_id, readings in self._history.items()},
+            "seq": self._seq,
+            "replayed": replayed,
+        }
+
+    def _replay_file(self, path):
+        """
+        重放一个 journal 文件中尚未应用的记录 (seq 大于快照和之前的文件)，遇到截断的尾行则截掉。
+        合并 tail 到 prev 时崩溃，两个文件可能包含相同的记录，按 seq 跳过即可。
+        """
+        if not os.path.exists(path):
+            return 0
+        replayed = 0
+        valid_bytes = 0
+        with open(path, 'rb') as f:
+            for raw_line in f:
+                if not raw_line.endswith(b"\n"):
+                    break # 最后一行未写完 (崩溃时的半条记录)
+                try:
+                    record = json.loads(raw_line)
+                except ValueError:
+                    break
+                valid_bytes += len(raw_line)
+                if record["seq"] <= self._seq:
+                    continue
+                self._apply(record)
+                self._seq = record["seq"]
+                replayed += 1
+        if valid_bytes < os.path.getsize(path):
+            print(f"StateJournal Warning: {path} 尾部有损坏/未写完的记录，已截断到 {valid_bytes} 字节。")
+            with open(path, 'r+b') as f:
+                f.truncate(valid_bytes)
+        return replayed
+
+    def _apply(self, record):
+        """把一条记录应用到内存物化视图"""
+        dev_id = record["id"]
+        ts = record["ts"]
+        self._devices[dev_id] = {"state": record["state"], "last_updated": ts}
+        if record.get("kind") == "reading":
+            history = self._history.get(dev_id)
+            if history is None:
+                history = self._history[dev_id] = deque()
+            history.append((ts, record["state"]))
+            cutoff = ts - self.history_retention
+            while history and history[0][0] < cutoff:
+                history.popleft()
+
+    # --- 写入 ---
+    def start(self):
+        """打开 journal 文件并启动后台 flush/快照线程"""
+        if not self._recovered:
+            self.recover()
+        self._journal_file = open(self._journal_path, 'ab')
+        self._stop_event.clear()
+        self._flusher_thread = threading.Thread(target=self._run_flusher, daemon=True)
+        self._flusher_thread.start()
+        print(f"StateJournal: 已启动 (目录 {self.data_dir}, durability={self.durability})。")
+        if os.path.exists(self._prev_journal_path) or os.path.exists(self._tail_journal_path):
+            # 上次运行在轮换后、快照完成前崩溃：prev 中的记录还不在任何快照里，立即写快照把它们固化
+            print("StateJournal: 发现未完成快照遗留的旧 journal，立即写入快照。")
+            self.snapshot()
+
+    def append(self, device_id, state, timestamp=None, kind="state"):
+        """
+        追加一条状态记录。
+        :param kind: "state" 表示设备状态变化，"reading" 表示传感器读数 (会计入历史)
+        :return: 该记录的序号
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if self._journal_file is None:
+                raise RuntimeError("StateJournal 尚未启动或已关闭")
+            self._seq += 1
+            record = {"seq": self._seq, "id": device_id, "state": state, "ts": timestamp, "kind": kind}
+            self._journal_file.write(json.dumps(record, separators=(",", ":")).encode('utf-8') + b"\n")
+            self._apply(record)
+            self._records_since_snapshot += 1
+            if self.durability == "always":
+                self._journal_file.flush()
+                os.fsync(self._journal_file.fileno())
+            else:
+                self._dirty = True
+            return self._seq
+
+    def _sync(self):
+        """把缓冲区写到 OS，必要时 fsync"""
+        with self._lock:
+            if not self._dirty or self._journal_file is None:
+                return
+            self._journal_file.flush()
+            if self.durability == "batch":
+                os.fsync(self._journal_file.fileno())
+            self._dirty = False
+
+    def _run_flusher(self):
+        """后台线程：批量 flush/fsync，并按时间或记录数触发快照"""
+        while not self._stop_event.wait(self.fsync_interval):
+            try:
+                self._sync()
+                if self._snapshot_due():
+                    self.snapshot()
+            except Exception as e:
+                print(f"StateJournal Error: 后台 flush/快照时出错: {e}")
+
+    def _snapshot_due(self):
+        if self._records_since_snapshot == 0:
+            return False
+        if self.snapshot_every > 0 and self._records_since_snapshot >= self.snapshot_every:
+            return True
+        return self.snapshot_interval > 0 and time.time() - self._last_snapshot_time >= self.snapshot_interval
+
+    # --- 快照 / 压缩 ---
+    def snapshot(self):
+        """
+        写入压缩快照并轮换 journal。
+        持锁期间只拷贝内存视图 (传感器历史较多时约几毫秒)、把缓冲区写到 OS 并改名 journal 文件；
+        fsync、合并 prev、序列化和写盘都在锁外进行，append 不会等待磁盘 I/O。
+        """
+        with self._snapshot_lock:
+            if os.path.exists(self._tail_journal_path):
+                self._merge_tail() # 上次合并时崩溃遗留的 tail
+            with self._lock:
+                if self._journal_file is None:
+                    return
+                snapshot_seq = self._seq
+                devices = {dev_id: dict(info) for dev_id, info in self._devices.items()}
+                history = {dev_id: list(readings) for dev_id, readings in self._history.items()}
+                # 轮换: 当前 journal 改名，新记录写到新的 journal。上一次快照没有完成 (崩溃或写入出错) 时
+                # prev 中的记录还不在任何快照里，不能覆盖它：改名为 tail，稍后追加到 prev 之后
+                self._journal_file.flush()
+                self._journal_file.close()
+                has_prev = os.path.exists(self._prev_journal_path)
+                rotated_path = self._tail_journal_path if has_prev else self._prev_journal_path
+                os.replace(self._journal_path, rotated_path)
+                self._journal_file = open(self._journal_path, 'ab')
+                self._dirty = False
+                self._records_since_snapshot = 0
+                self._last_snapshot_time = time.time()
+
+            start_time = time.time()
+            with open(rotated_path, 'rb') as f:
+                os.fsync(f.fileno())
+            if has_prev:
+                self._merge_tail()
+            self._fsync_dir()
+            tmp_path = self._snapshot_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({"seq": snapshot_seq, "created": time.time(),
+                           "devices": devices, "history": history}, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._snapshot_path) # 原子替换
+            self._fsync_dir()
+            # 快照已包含 prev journal 中的全部记录，可以删除
+            if os.path.exists(self._prev_journal_path):
+                os.remove(self._prev_journal_path)
+            print(f"StateJournal: 已写入快照 seq={snapshot_seq} ({len(devices)} 个设备)，"
+                  f"耗时 {(time.time() - start_time) * 1000:.1f} ms。")
+
+    def _merge_tail(self):
+        """把 tail 追加到 prev 之后并删除 tail (在 _snapshot_lock 内、_lock 外调用)"""
+        if not os.path.exists(self._prev_journal_path):
+            os.replace(self._tail_journal_path, self._prev_journal_path)
+            return
+        with open(self._tail_journal_path, 'rb') as src, open(self._prev_journal_path, 'ab') as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(self._tail_journal_path)
+
+    def _fsync_dir(self):
+        """fsync 目录，确保 rename 持久化 (部分平台不支持，忽略错误)"""
+        try:
+            dir_fd = os.open(self.data_dir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    def close(self):
+        """停止后台线程，刷盘并关闭 journal"""
+        self._stop_event.set()
+        if self._flusher_thread and self._flusher_thread.is_alive():
+            self._flusher_thread.join(timeout=5)
+        with self._lock:
+            if self._journal_file is not None:
+                self._journal_file.flush()
+                if self.durability != "none":
+                    os.fsync(self._journal_file.fileno())
+                self._journal_file.close()
+                self._journal_file = None
+        print("StateJournal: 已关闭。")
+
+    # --- 查询 ---
+    def get_device_state(self, device_id):
+        """返回日志中记录的设备最新状态 (副本)，没有记录则返回 None"""
+        with self._lock:
+            info = self._devices.get(device_id)
+            return dict(info) if info else None
+
+    def get_history(self, device_id, since=None):
+        """返回传感器历史读数列表 [(ts, value), ...]，可按起始时间过滤"""
+        with self._lock:
+            readings = list(self._history.get(device_id, ()))
+        if since is not None:
+            readings = [item for item in readings if item[0] >= since]
+        return readings
+
+
+# --- 测试代码 / 恢复时间测量 ---
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+
+    NUM_DEVICES = 1000
+    NUM_SENSORS = 100          # 其中 100 个是温度传感器
+    READING_INTERVAL = 30      # 每 30 秒一次读数 (与 read_sensor_task 一致)
+    DAY = 86400
+
+    def run_benchmark(label, snapshot_before_tail):
+        data_dir = tempfile.mkdtemp(prefix="smart_home_journal_")
+        try:
+            journal = StateJournal(data_dir, durability="none", snapshot_interval=0, snapshot_every=0)
+            journal.start()
+            base_time = time.time() - DAY
+            for i in range(NUM_DEVICES - NUM_SENSORS):
+                journal.append(f"light_{i}", "on" if i % 2 else "off", base_time)
+            readings_per_sensor = DAY // READING_INTERVAL
+            tail_start = readings_per_sensor - 3600 // READING_INTERVAL # 最后一小时作为 journal 尾部
+            for step in range(readings_per_sensor):
+                if snapshot_before_tail and step == tail_start:
+                    journal.snapshot()
+                ts = base_time + step * READING_INTERVAL
+                for s in range(NUM_SENSORS):
+                    journal.append(f"sensor_{s}", round(20.0 + (step % 50) * 0.1, 1), ts, kind="reading")
+            journal.close()
+            total_records = journal._seq
+
+            recovering = StateJournal(data_dir)
+            start_time = time.perf_counter()
+            result = recovering.recover()
+            elapsed = time.perf_counter() - start_time
+            history_len = sum(len(r) for r in result["history"].values())
+            print(f"[{label}] 记录总数 {total_records}，恢复 {len(result['devices'])} 个设备 / "
+                  f"{history_len} 条历史读数，重放 {result['replayed']} 条，耗时 {elapsed * 1000:.1f} ms")
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(f"测量恢复时间: {NUM_DEVICES} 个设备，{NUM_SENSORS} 个传感器 x 一天读数 (每 {READING_INTERVAL} 秒)...")
+    run_benchmark("仅 journal 重放", snapshot_before_tail=False)
+    run_benchmark("快照 + 1 小时 journal 尾部", snapshot_before_tail=True)